@@ -18,7 +18,12 @@ import pandas as pd
 import seaborn as sns
 import scipy
 import sklearn
+import gzip
+import os
+import shutil
+import struct
 import sys
+import time
 import torch
 import torchvision
 
@@ -154,10 +159,240 @@ def get_dataset_from_csv(path: str, delimiter: str = ',', ignore_header: bool =
     return df
 
 
+class BatchAugmentation:
+    """
+    Random flips (and optionally inversion and normalization) applied to a whole batch of images
+    at once with masked operations, instead of to one image at a time. The random numbers are
+    drawn from PyTorch's global random number generator, so the augmentations are reproducible
+    with `set_seed`. Use `collate` as the `collate_fn` of a DataLoader.
+    """
+    
+    def __init__(self, horizontal_flip_p: Union[int, float] = 0, vertical_flip_p: Union[int, float] = 0,
+                 invert: bool = False, mean: float = None, std: float = None):
+        """
+        :param horizontal_flip_p: Probability of flipping each image horizontally.
+        :param vertical_flip_p: Probability of flipping each image vertically.
+        :param invert: Whether to invert the pixels (of images in the range [0, 1], or uint8).
+        :param mean: If given, normalize the pixels with this mean and standard deviation `std`.
+        :param std: Standard deviation for normalizing the pixels.
+        """
+        assert 0 <= horizontal_flip_p <= 1, 'Horizontal flip probability needs to be in the range [0, 1].'
+        assert 0 <= vertical_flip_p <= 1, 'Vertical flip probability needs to be in the range [0, 1].'
+        assert (mean is None) == (std is None), 'Normalization requires both mean and std.'
+        self.horizontal_flip_p = horizontal_flip_p
+        self.vertical_flip_p = vertical_flip_p
+        self.invert = invert
+        self.mean = mean
+        self.std = std
+    
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Augment a batch of images.
+        
+        :param inputs: Batch of images of shape (B, C, H, W). Images of type uint8 are converted
+            to float in the range [0, 1] first.
+        :return: The augmented batch.
+        """
+        if inputs.dtype == torch.uint8:
+            inputs = inputs.float().div_(255)
+        for p, dim in ((self.horizontal_flip_p, -1), (self.vertical_flip_p, -2)):
+            if p:
+                # one random decision per image, broadcast over channels and pixels
+                flip = (torch.rand(len(inputs)) < p).to(inputs.device).view(-1, *[1] * (inputs.dim() - 1))
+                inputs = torch.where(flip, inputs.flip(dim), inputs)
+        if self.invert:
+            inputs = 1 - inputs
+        if self.mean is not None:
+            inputs = (inputs - self.mean) / self.std
+        return inputs
+    
+    def collate(self, samples: list) -> Tuple[torch.Tensor, ...]:
+        """
+        Collate function for DataLoaders: stack the samples into a batch and augment the inputs.
+        """
+        inputs, *rest = torch.utils.data.default_collate(samples)
+        return (self(inputs), *rest)
+
+
+class TensorBatchLoader:
+    """
+    Data loader for datasets that are fully held in memory as tensors (a TensorDataset, or a
+    Subset of one). Instead of fetching the samples one by one and stacking them, each batch is
+    taken from the tensors with a single indexing operation (or a slice, if not shuffled). Like a
+    DataLoader, it has a `dataset`, a `batch_size` and a length (the number of batches), and
+    shuffling is reproducible with `set_seed`.
+    """
+    
+    def __init__(self, dataset: torch.utils.data.Dataset, batch_size: int = 1, shuffle: bool = False,
+                 drop_last: bool = False, augmentations: Callable[[torch.Tensor], torch.Tensor] = None):
+        """
+        :param dataset: A TensorDataset or a (nested) Subset of a TensorDataset.
+        :param batch_size: Number of samples per batch.
+        :param shuffle: Whether to draw the samples in a new random order in each epoch.
+        :param drop_last: Whether to drop the last batch if it is incomplete.
+        :param augmentations: Function applied to the inputs of each batch (see `BatchAugmentation`).
+        """
+        assert batch_size >= 1, 'Batch size needs to be >= 1.'
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.augmentations = augmentations
+        # resolve subsets into indices of the underlying tensors (None means all, in order)
+        self.indices = None
+        while isinstance(dataset, torch.utils.data.Subset):
+            indices = torch.as_tensor(dataset.indices, dtype=torch.long)
+            self.indices = indices if self.indices is None else indices[self.indices]
+            dataset = dataset.dataset
+        assert isinstance(dataset, torch.utils.data.TensorDataset), \
+            'Invalid dataset (must be a TensorDataset or a Subset of one).'
+        self.tensors = dataset.tensors
+    
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return int(np.ceil(len(self.dataset) / self.batch_size))
+    
+    def __iter__(self):
+        num_samples = len(self.dataset)
+        order = self.indices
+        if self.shuffle:
+            permutation = torch.randperm(num_samples)
+            order = permutation if order is None else order[permutation]
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            if order is None:
+                batch = tuple(tensor[start:start + self.batch_size] for tensor in self.tensors)
+            else:
+                batch = tuple(tensor[order[start:start + self.batch_size]] for tensor in self.tensors)
+            if self.augmentations is not None:
+                batch = (self.augmentations(batch[0]),) + batch[1:]
+            yield batch
+
+
+# numpy data types of the IDX file format (see http://yann.lecun.com/exdb/mnist/)
+IDX_DTYPES = {0x08: np.uint8, 0x09: np.int8, 0x0B: '>i2', 0x0C: '>i4', 0x0D: '>f4', 0x0E: '>f8'}
+
+
+def read_idx(path: Union[str, Path], mode: str = 'r') -> np.ndarray:
+    """
+    Memory-map an array stored in a file in IDX format (e.g., "t10k-labels-idx1-ubyte"), so it is
+    not read until it is accessed. If only a gzip-compressed version of the file exists (with the
+    suffix ".gz"), it is decompressed next to it first.
+
+    :param path: The IDX file.
+    :param mode: Mode of the memory map: "r" (read-only) or "c" (copy-on-write, i.e., changes are
+        kept in memory and not written to the file).
+    :return: The memory-mapped array.
+    """
+    path = Path(path)
+    if not path.exists():
+        compressed = path.with_name(path.name + '.gz')
+        if not compressed.exists():
+            raise FileNotFoundError(f"Neither {path} nor {compressed} exist.")
+        tmp_path = path.with_name(path.name + '.tmp')
+        with gzip.open(compressed, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, path)
+    with open(path, 'rb') as f:
+        zeros, dtype, ndim = struct.unpack('>HBB', f.read(4))
+        assert zeros == 0 and dtype in IDX_DTYPES, f'{path} is not an IDX file.'
+        shape = struct.unpack('>' + 'I' * ndim, f.read(4 * ndim))
+    return np.memmap(path, dtype=IDX_DTYPES[dtype], mode=mode, offset=4 + 4 * ndim, shape=shape)
+
+
+def load_mnist(root: str = "resources", variant: str = "MNIST", train: bool = True,
+               download: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the images and labels of MNIST or FashionMNIST directly from the IDX files in the
+    "<root>/<variant>/raw" directory (memory-mapped, copy-on-write). This works offline; only if
+    the files do not exist (not even gzip-compressed), they are downloaded with torchvision.
+
+    :param root: Path where the data is stored.
+    :param variant: Either "MNIST" or "FashionMNIST".
+    :param train: Whether to load the training set (or the test set).
+    :param download: Whether to download missing files.
+    :return: A tuple of the images (N x 28 x 28, uint8) and the labels (N, uint8).
+    """
+    raw = Path(root) / variant / 'raw'
+    prefix = 'train' if train else 't10k'
+    names = [f'{prefix}-images-idx3-ubyte', f'{prefix}-labels-idx1-ubyte']
+    if download and not all((raw / name).exists() or (raw / (name + '.gz')).exists() for name in names):
+        getattr(torchvision.datasets, variant)(root=root, train=train, download=True)
+    images, labels = (read_idx(raw / name, mode='c') for name in names)
+    return images, labels
+
+
+class IDXDataset(torch.utils.data.Dataset):
+    """
+    Data set of memory-mapped images and labels (see `load_mnist`), optionally transformed.
+    """
+
+    def __init__(self, images: np.ndarray, labels: np.ndarray, transform: Callable = None):
+        assert len(images) == len(labels), 'Number of images and labels must match.'
+        self.images = images
+        self.labels = labels
+        self.transform = transform
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+        image = np.asarray(self.images[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.labels[index])
+
+
+class MNISTTensorDataset(torch.utils.data.TensorDataset):
+    """
+    TensorDataset of uint8 images and labels with the attributes of the torchvision MNIST data
+    sets (`data`, `targets` and `classes`). Indexing it augments the single sample, whereas a
+    TensorBatchLoader takes whole batches from `tensors` and augments them at once.
+    """
+
+    def __init__(self, images: torch.Tensor, targets: torch.Tensor, classes: Sequence[str],
+                 augmentations: BatchAugmentation = None):
+        """
+        :param images: Images of shape (N, H, W) and type uint8.
+        :param targets: Labels of shape (N,).
+        :param classes: Names of the classes.
+        :param augmentations: Function applied to the images (see `BatchAugmentation`).
+        """
+        super().__init__(images[:, np.newaxis], targets)
+        self.data = images
+        self.targets = targets
+        self.classes = list(classes)
+        self.augmentations = augmentations
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        image, target = super().__getitem__(index)
+        if self.augmentations is not None:
+            image = self.augmentations(image[np.newaxis])[0]
+        return image, target
+
+
+def _get_dataset_mnist(variant: str, batch_size: int, horizontal_flip_p: Union[int, float],
+                       vertical_flip_p: Union[int, float], invert: bool, train_store_path: str,
+                       test_store_path: str) -> Tuple[TensorBatchLoader, TensorBatchLoader]:
+    # the images are kept as uint8 tensors (memory-mapped from the IDX files) and converted,
+    # flipped, inverted and normalized one whole batch at a time
+    assert batch_size >= 1, 'Batch size needs to be >= 1.'
+    augmentations = BatchAugmentation(horizontal_flip_p, vertical_flip_p, invert=invert, mean=0.1307, std=0.3081)
+    loaders = []
+    for train, store_path in ((True, train_store_path), (False, test_store_path)):
+        images, labels = load_mnist(store_path, variant, train=train)
+        dataset = MNISTTensorDataset(torch.from_numpy(images), torch.from_numpy(labels.astype(np.int64)),
+                                     classes=getattr(torchvision.datasets, variant).classes,
+                                     augmentations=augmentations)
+        loaders.append(TensorBatchLoader(dataset, batch_size=batch_size, shuffle=train,
+                                         augmentations=augmentations))
+    return tuple(loaders)
+
+
 def get_dataset_mnist(batch_size: int, horizontal_flip_p: Union[int, float] = 0,
                       vertical_flip_p: Union[int, float] = 0, invert: bool = False,
                       train_store_path: str = "resources", test_store_path: str = "resources"
-                      ) -> Tuple[DataLoader, DataLoader]:
+                      ) -> Tuple[TensorBatchLoader, TensorBatchLoader]:
     """
     Load MNIST data sets (training and test).
 
@@ -169,31 +404,16 @@ def get_dataset_mnist(batch_size: int, horizontal_flip_p: Union[int, float] = 0,
     :param test_store_path: Path where the MNIST test data will be stored.
     :return: Tuple comprising a data loader for training [0] as well as test set [1].
     """
-    assert batch_size >= 1, 'Batch size needs to be >= 1.'
     assert 0 <= horizontal_flip_p <= 1, 'Horizontal flip probability needs to be in the range [0, 1].'
     assert 0 <= vertical_flip_p <= 1, 'Vertical flip probability needs to be in the range [0, 1].'
-
-    transforms = torchvision.transforms.Compose([
-        torchvision.transforms.ToTensor(),
-        lambda x: 255.0 - torch.as_tensor(x) if invert else x,
-        torchvision.transforms.Normalize(mean=0.1307, std=0.3081),
-        torchvision.transforms.RandomHorizontalFlip(p=horizontal_flip_p),
-        torchvision.transforms.RandomVerticalFlip(p=vertical_flip_p)
-    ])
-
-    return (DataLoader(
-        dataset=torchvision.datasets.MNIST(root=train_store_path, train=True, download=True, transform=transforms),
-        batch_size=batch_size, shuffle=True
-    ), DataLoader(
-        dataset=torchvision.datasets.MNIST(root=test_store_path, train=False, download=True, transform=transforms),
-        batch_size=batch_size, shuffle=False
-    ))
+    return _get_dataset_mnist('MNIST', batch_size, horizontal_flip_p, vertical_flip_p, invert,
+                              train_store_path, test_store_path)
 
 
 def get_dataset_fashionmnist(batch_size: int, horizontal_flip_p: Union[int, float] = 0,
                       vertical_flip_p: Union[int, float] = 0, invert: bool = False,
                       train_store_path: str = "resources", test_store_path: str = "resources"
-                      ) -> Tuple[DataLoader, DataLoader]:
+                      ) -> Tuple[TensorBatchLoader, TensorBatchLoader]:
     """
     Load MNIST data sets (training and test).
 
@@ -205,25 +425,55 @@ def get_dataset_fashionmnist(batch_size: int, horizontal_flip_p: Union[int, floa
     :param test_store_path: Path where the MNIST test data will be stored.
     :return: Tuple comprising a data loader for training [0] as well as test set [1].
     """
-    assert batch_size >= 1, 'Batch size needs to be >= 1.'
     assert 0 <= horizontal_flip_p <= 1, 'Horizontal flip probability needs to be in the range [0, 1].'
     assert 0 <= vertical_flip_p <= 1, 'Vertical flip probability needs to be in the range [0, 1].'
+    return _get_dataset_mnist('FashionMNIST', batch_size, horizontal_flip_p, vertical_flip_p, invert,
+                              train_store_path, test_store_path)
+
+
+def benchmark_mnist_loaders(batch_size: int = 64, horizontal_flip_p: Union[int, float] = 0.5,
+                            vertical_flip_p: Union[int, float] = 0.5, invert: bool = True,
+                            store_path: str = "resources", variant: str = "MNIST",
+                            num_workers: int = 0) -> pd.DataFrame:
+    """
+    Measure the time of one epoch over the training set with the per-sample transforms
+    (ToTensor, inversion, Normalize and random flips for each image in a DataLoader) and with
+    the loaders of `get_dataset_mnist` (whole batches of preconverted tensors).
 
+    :param batch_size: Size of a mini-batch used by the data loaders.
+    :param horizontal_flip_p: Probability of flipping images horizontally.
+    :param vertical_flip_p: Probability of flipping images vertically.
+    :param invert: Whether to invert the pixels of an image.
+    :param store_path: Path where the data is stored.
+    :param variant: Either "MNIST" or "FashionMNIST".
+    :param num_workers: Number of worker processes of the per-sample DataLoader.
+    :return: Number of batches, seconds per epoch and speedup over the per-sample transforms
+        (columns) per loader (rows).
+    """
+    assert variant in ('MNIST', 'FashionMNIST'), 'Variant must be either "MNIST" or "FashionMNIST".'
     transforms = torchvision.transforms.Compose([
         torchvision.transforms.ToTensor(),
-        lambda x: 255.0 - torch.as_tensor(x) if invert else x,
+        lambda x: 1.0 - x if invert else x,
         torchvision.transforms.Normalize(mean=0.1307, std=0.3081),
         torchvision.transforms.RandomHorizontalFlip(p=horizontal_flip_p),
         torchvision.transforms.RandomVerticalFlip(p=vertical_flip_p)
     ])
-
-    return (DataLoader(
-        dataset=torchvision.datasets.FashionMNIST(root=train_store_path, train=True, download=True, transform=transforms),
-        batch_size=batch_size, shuffle=True
-    ), DataLoader(
-        dataset=torchvision.datasets.FashionMNIST(root=test_store_path, train=False, download=True, transform=transforms),
-        batch_size=batch_size, shuffle=False
-    ))
+    loaders = {
+        'per-sample transforms': DataLoader(
+            dataset=IDXDataset(*load_mnist(store_path, variant, train=True), transform=transforms),
+            batch_size=batch_size, shuffle=True, num_workers=num_workers),
+        'batch transforms': _get_dataset_mnist(variant, batch_size, horizontal_flip_p, vertical_flip_p, invert,
+                                               store_path, store_path)[0]
+    }
+    results = {}
+    for name, loader in loaders.items():
+        start = time.perf_counter()
+        for _ in loader:
+            pass
+        results[name] = {'batches': len(loader), 'epoch s': time.perf_counter() - start}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results['speedup'] = results['epoch s'].iloc[0] / results['epoch s']
+    return results
 
 
 def plot_model(dataset: pd.DataFrame, coefficients: Sequence[Sequence[Union[int, float]]],
@@ -311,7 +561,7 @@ def minimize_mse(dataset: pd.DataFrame, degree: int = 1) -> Tuple[Union[float, i
     return np.polyfit(x=dataset[dataset.columns[0]], y=dataset[dataset.columns[1]], deg=degree).tolist()[::-1]
 
 
-def minimize_ce(dataset: Union[pd.DataFrame, DataLoader], iterations: int,
+def minimize_ce(dataset: Union[pd.DataFrame, DataLoader, TensorBatchLoader], iterations: int,
                 learning_rate: Union[float, int], momentum: Union[float, int],
                 use_cuda_if_available: bool = True) -> Tuple[Union[float, int], ...]:
     """
@@ -324,7 +574,8 @@ def minimize_ce(dataset: Union[pd.DataFrame, DataLoader], iterations: int,
     :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
     :return: Coefficients minimizing the cross-entropy loss.
     """
-    assert type(dataset) in (pd.DataFrame, DataLoader), 'Invalid dataset (must be pd.DataFrame or PyTorch DataLoader).'
+    assert type(dataset) in (pd.DataFrame, DataLoader, TensorBatchLoader), \
+        'Invalid dataset (must be pd.DataFrame, PyTorch DataLoader or TensorBatchLoader).'
     assert iterations >= 0, 'Iterations must be non-negative.'
     assert (type(learning_rate) in (int, float)) and learning_rate > 0, 'Learning-rate must be > 0.'
     assert (type(momentum) in (int, float)) and momentum >= 0, 'Momentum must be non-negative.'
@@ -335,6 +586,8 @@ def minimize_ce(dataset: Union[pd.DataFrame, DataLoader], iterations: int,
         data = torch.from_numpy(dataset[dataset.columns[:-1]].to_numpy()).to(dtype=torch.float32)
         targets = torch.from_numpy(dataset[dataset.columns[-1]].to_numpy()).to(dtype=torch.long)
         dataset, input_size, output_size = ((data, targets),), data.shape[1], len(targets.unique())
+    elif type(dataset) == TensorBatchLoader:
+        input_size, output_size = prod(dataset.tensors[0].shape[1:]), len(dataset.tensors[1].unique())
     else:
         input_size, output_size = prod(dataset.dataset[0][0].shape), len(set(_[1] for _ in dataset.dataset))
 
@@ -12,7 +12,15 @@ personal and non-commercial educational use only. Any reproduction of this
 material, no matter whether as a whole or in parts, no matter whether in printed
 or in electronic form, requires explicit prior acceptance of the authors.
 """
+import copy
+import gzip
+import inspect
+import io
 import math
+import os
+import shutil
+import struct
+import time
 import warnings
 
 import matplotlib
@@ -31,6 +39,7 @@ import tqdm as tqdm_
 
 from packaging.version import Version
 from IPython.core.display import HTML
+from pathlib import Path
 from torch.utils.data import DataLoader
 from typing import Callable, Sequence, Tuple, Union, Dict, List
 from tqdm.autonotebook import tqdm
@@ -305,10 +314,189 @@ class AugmentedTensorDataset(torch.utils.data.TensorDataset):
         return item
 
 
+class BatchAugmentation:
+    """
+    Random flips (and optionally inversion and normalization) applied to a whole batch of images
+    at once with masked operations, instead of to one image at a time. The random numbers are
+    drawn from PyTorch's global random number generator, so the augmentations are reproducible
+    with `set_seed`. Use `collate` as the `collate_fn` of a DataLoader.
+    """
+    
+    def __init__(self, horizontal_flip_p: Union[int, float] = 0, vertical_flip_p: Union[int, float] = 0,
+                 invert: bool = False, mean: float = None, std: float = None):
+        """
+        :param horizontal_flip_p: Probability of flipping each image horizontally.
+        :param vertical_flip_p: Probability of flipping each image vertically.
+        :param invert: Whether to invert the pixels (of images in the range [0, 1], or uint8).
+        :param mean: If given, normalize the pixels with this mean and standard deviation `std`.
+        :param std: Standard deviation for normalizing the pixels.
+        """
+        assert 0 <= horizontal_flip_p <= 1, 'Horizontal flip probability needs to be in the range [0, 1].'
+        assert 0 <= vertical_flip_p <= 1, 'Vertical flip probability needs to be in the range [0, 1].'
+        assert (mean is None) == (std is None), 'Normalization requires both mean and std.'
+        self.horizontal_flip_p = horizontal_flip_p
+        self.vertical_flip_p = vertical_flip_p
+        self.invert = invert
+        self.mean = mean
+        self.std = std
+    
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Augment a batch of images.
+        
+        :param inputs: Batch of images of shape (B, C, H, W). Images of type uint8 are converted
+            to float in the range [0, 1] first.
+        :return: The augmented batch.
+        """
+        if inputs.dtype == torch.uint8:
+            inputs = inputs.float().div_(255)
+        for p, dim in ((self.horizontal_flip_p, -1), (self.vertical_flip_p, -2)):
+            if p:
+                # one random decision per image, broadcast over channels and pixels
+                flip = (torch.rand(len(inputs)) < p).to(inputs.device).view(-1, *[1] * (inputs.dim() - 1))
+                inputs = torch.where(flip, inputs.flip(dim), inputs)
+        if self.invert:
+            inputs = 1 - inputs
+        if self.mean is not None:
+            inputs = (inputs - self.mean) / self.std
+        return inputs
+    
+    def collate(self, samples: list) -> Tuple[torch.Tensor, ...]:
+        """
+        Collate function for DataLoaders: stack the samples into a batch and augment the inputs.
+        """
+        inputs, *rest = torch.utils.data.default_collate(samples)
+        return (self(inputs), *rest)
+
+
+class TensorBatchLoader:
+    """
+    Data loader for datasets that are fully held in memory as tensors (a TensorDataset, or a
+    Subset of one). Instead of fetching the samples one by one and stacking them, each batch is
+    taken from the tensors with a single indexing operation (or a slice, if not shuffled). Like a
+    DataLoader, it has a `dataset`, a `batch_size` and a length (the number of batches), and
+    shuffling is reproducible with `set_seed`.
+    """
+    
+    def __init__(self, dataset: torch.utils.data.Dataset, batch_size: int = 1, shuffle: bool = False,
+                 drop_last: bool = False, augmentations: Callable[[torch.Tensor], torch.Tensor] = None):
+        """
+        :param dataset: A TensorDataset or a (nested) Subset of a TensorDataset.
+        :param batch_size: Number of samples per batch.
+        :param shuffle: Whether to draw the samples in a new random order in each epoch.
+        :param drop_last: Whether to drop the last batch if it is incomplete.
+        :param augmentations: Function applied to the inputs of each batch (see `BatchAugmentation`).
+        """
+        assert batch_size >= 1, 'Batch size needs to be >= 1.'
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.augmentations = augmentations
+        # resolve subsets into indices of the underlying tensors (None means all, in order)
+        self.indices = None
+        while isinstance(dataset, torch.utils.data.Subset):
+            indices = torch.as_tensor(dataset.indices, dtype=torch.long)
+            self.indices = indices if self.indices is None else indices[self.indices]
+            dataset = dataset.dataset
+        assert isinstance(dataset, torch.utils.data.TensorDataset), \
+            'Invalid dataset (must be a TensorDataset or a Subset of one).'
+        assert not getattr(dataset, 'transform_input', None), \
+            'Per-sample transforms are not supported (use augmentations instead).'
+        self.tensors = dataset.tensors
+    
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return int(np.ceil(len(self.dataset) / self.batch_size))
+    
+    def __iter__(self):
+        num_samples = len(self.dataset)
+        order = self.indices
+        if self.shuffle:
+            permutation = torch.randperm(num_samples)
+            order = permutation if order is None else order[permutation]
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            if order is None:
+                batch = tuple(tensor[start:start + self.batch_size] for tensor in self.tensors)
+            else:
+                batch = tuple(tensor[order[start:start + self.batch_size]] for tensor in self.tensors)
+            if self.augmentations is not None:
+                batch = (self.augmentations(batch[0]),) + batch[1:]
+            yield batch
+
+
+# numpy data types of the IDX file format (see http://yann.lecun.com/exdb/mnist/)
+IDX_DTYPES = {0x08: np.uint8, 0x09: np.int8, 0x0B: '>i2', 0x0C: '>i4', 0x0D: '>f4', 0x0E: '>f8'}
+
+
+def read_idx(path: Union[str, Path], mode: str = 'r') -> np.ndarray:
+    """
+    Memory-map an array stored in a file in IDX format (e.g., "t10k-labels-idx1-ubyte"), so it is
+    not read until it is accessed. If only a gzip-compressed version of the file exists (with the
+    suffix ".gz"), it is decompressed next to it first.
+
+    :param path: The IDX file.
+    :param mode: Mode of the memory map: "r" (read-only) or "c" (copy-on-write, i.e., changes are
+        kept in memory and not written to the file).
+    :return: The memory-mapped array.
+    """
+    path = Path(path)
+    if not path.exists():
+        compressed = path.with_name(path.name + '.gz')
+        if not compressed.exists():
+            raise FileNotFoundError(f"Neither {path} nor {compressed} exist.")
+        tmp_path = path.with_name(path.name + '.tmp')
+        with gzip.open(compressed, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, path)
+    with open(path, 'rb') as f:
+        zeros, dtype, ndim = struct.unpack('>HBB', f.read(4))
+        assert zeros == 0 and dtype in IDX_DTYPES, f'{path} is not an IDX file.'
+        shape = struct.unpack('>' + 'I' * ndim, f.read(4 * ndim))
+    return np.memmap(path, dtype=IDX_DTYPES[dtype], mode=mode, offset=4 + 4 * ndim, shape=shape)
+
+
+def load_mnist(root: str = "resources", variant: str = "MNIST", train: bool = True,
+               download: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the images and labels of MNIST or FashionMNIST directly from the IDX files in the
+    "<root>/<variant>/raw" directory (memory-mapped, copy-on-write). This works offline; only if
+    the files do not exist (not even gzip-compressed), they are downloaded with torchvision.
+
+    :param root: Path where the data is stored.
+    :param variant: Either "MNIST" or "FashionMNIST".
+    :param train: Whether to load the training set (or the test set).
+    :param download: Whether to download missing files.
+    :return: A tuple of the images (N x 28 x 28, uint8) and the labels (N, uint8).
+    """
+    raw = Path(root) / variant / 'raw'
+    prefix = 'train' if train else 't10k'
+    names = [f'{prefix}-images-idx3-ubyte', f'{prefix}-labels-idx1-ubyte']
+    if download and not all((raw / name).exists() or (raw / (name + '.gz')).exists() for name in names):
+        getattr(torchvision.datasets, variant)(root=root, train=train, download=True)
+    images, labels = (read_idx(raw / name, mode='c') for name in names)
+    return images, labels
+
+
+def _cached_arrays(paths: Sequence[Path], compute: Callable[[], Sequence[np.ndarray]]) -> List[np.ndarray]:
+    # load arrays from .npy files (memory-mapped, copy-on-write), computing and storing them first
+    # if any of the files is missing
+    if not all(path.exists() for path in paths):
+        for path, array in zip(paths, compute()):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+    return [np.load(path, mmap_mode='c') for path in paths]
+
+
 def get_dataset_mnist(batch_size: int = 20, horizontal_flip_p: Union[int, float] = 0,
                       vertical_flip_p: Union[int, float] = 0, invert: bool = False, valid_size: float = 0,
                       augment_train:bool = True, augment_test: bool = False, random_state: int = 42,
-                      root: str = "resources", variant: str = "MNIST") -> Tuple[DataLoader, ...]:
+                      root: str = "resources", uint8_storage: bool = False, download: bool = True,
+                      variant: str = "MNIST") -> Tuple[TensorBatchLoader, ...]:
     """
     Load MNIST data sets (training, optional validation, and test).
 
@@ -321,65 +509,193 @@ def get_dataset_mnist(batch_size: int = 20, horizontal_flip_p: Union[int, float]
     :param valid_size: Fraction of training set to keep for validation.
     :param random_state: Random state for splitting off the validation set.
     :param root: Path where the data will be stored.
+    :param uint8_storage: Whether to keep the images as uint8 (a quarter of the memory) and invert
+        and normalize each batch when it is loaded, instead of converting all images up front.
+    :param download: Whether to download the data if it is not found in `root` (otherwise, it is
+        read from the IDX files, see `load_mnist`).
     :param variant: Either "MNIST" or "FashionMNIST".
     :return: If valid_size is 0, a tuple comprising a data loader for training [0] as well as
         test set [1]. If valid_size is > 0, a tuple comprising a data loader for training [0],
-        validation [1] as well as test set [2].
+        validation [1] as well as test set [2]. The preconverted images and the indices of the
+        validation split are cached in "<root>/<variant>/cache", so subsequent calls with the
+        same arguments only need to memory-map them.
     """
     assert batch_size >= 1, 'Batch size needs to be >= 1.'
     assert 0 <= horizontal_flip_p <= 1, 'Horizontal flip probability needs to be in the range [0, 1].'
     assert 0 <= vertical_flip_p <= 1, 'Vertical flip probability needs to be in the range [0, 1].'
     assert 0 <= valid_size < 1, 'Validation set fraction must be in the range [0, 1)'
     assert variant in ('MNIST', 'FashionMNIST'), 'Variant must be either "MNIST" or "FashionMNIST".'
+    mean, std = 0.1307, 0.3081
+    cache = Path(root) / variant / 'cache'
     
-    def prepare_dataset(dataset: Union[torchvision.datasets.MNIST, torchvision.datasets.FashionMNIST],
-                        invert: bool, mean: float = 0.1307, std: float = 0.3081,
-                        augmentations=None):
-        """Takes an MNIST dataset and returns a TensorDataset with preconverted images."""
-        X, Y = dataset.data, dataset.targets
-        if invert:
-            X = X ^ 255
-        X = X.float().div_(255).sub_(mean).div_(std)  # normalize
-        X = X[:, np.newaxis]  # insert channel dimension
-        return AugmentedTensorDataset(X, Y, transform_input=augmentations)
-    
-    # on-the-fly transformations
-    augmentations = []
-    if horizontal_flip_p:
-        augmentations.append(torchvision.transforms.RandomHorizontalFlip(p=horizontal_flip_p))
-    if vertical_flip_p:
-        augmentations.append(torchvision.transforms.RandomVerticalFlip(p=vertical_flip_p))
-    if augmentations:
-        augmentations = torchvision.transforms.Compose(augmentations)
-    else:
-        augmentations = None
+    def prepare_dataset(train: bool, invert: bool):
+        """Loads an MNIST split and returns a TensorDataset with preconverted images."""
+        X, Y = load_mnist(root, variant, train=train, download=download)
+        if not uint8_storage:  # otherwise, each batch is inverted and normalized when loaded
+            def normalize():
+                images = X ^ 255 if invert else X
+                return [(images.astype(np.float32) / 255 - np.float32(mean)) / np.float32(std)]
+            name = f'{"train" if train else "test"}_invert{int(invert)}_mean{mean}_std{std}.npy'
+            X, = _cached_arrays([cache / name], normalize)
+        X = torch.from_numpy(X)[:, np.newaxis]  # insert channel dimension
+        Y = torch.from_numpy(Y.astype(np.int64))
+        return AugmentedTensorDataset(X, Y, transform_input=None)
     
-    datasetclass = getattr(torchvision.datasets, variant)
+    # on-the-fly transformations, applied to whole batches (including inversion and
+    # normalization for uint8 storage)
+    normalization = dict(invert=invert, mean=mean, std=std) if uint8_storage else {}
+    
+    def batch_augmentations(flip: bool) -> BatchAugmentation:
+        if flip and (horizontal_flip_p or vertical_flip_p):
+            return BatchAugmentation(horizontal_flip_p, vertical_flip_p, **normalization)
+        return BatchAugmentation(**normalization) if uint8_storage else None
+    
+    train_augmentations = batch_augmentations(augment_train)
+    test_augmentations = batch_augmentations(augment_test)
     
     loaders = []
-    trainset = datasetclass(root=root, train=True, download=True)
-    trainset = prepare_dataset(trainset, invert, augmentations=augment_train and augmentations)
+    trainset = prepare_dataset(True, invert)
     if valid_size:
-        train_idxs, valid_idxs = sklearn.model_selection.train_test_split(np.arange(len(trainset)),
-                                                                          test_size=valid_size,
-                                                                          random_state=random_state,
-                                                                          stratify=trainset.tensors[1].numpy())
+        split = cache / f'split_valid{valid_size}_seed{random_state}'
+        train_idxs, valid_idxs = _cached_arrays(
+            [split.with_name(split.name + '_train.npy'), split.with_name(split.name + '_valid.npy')],
+            lambda: sklearn.model_selection.train_test_split(np.arange(len(trainset)),
+                                                             test_size=valid_size,
+                                                             random_state=random_state,
+                                                             stratify=trainset.tensors[1].numpy()))
         validset = torch.utils.data.Subset(trainset, valid_idxs)
         trainset = torch.utils.data.Subset(trainset, train_idxs)
-    loaders.append(DataLoader(dataset=trainset, batch_size=batch_size, shuffle=True))
+    loaders.append(TensorBatchLoader(trainset, batch_size=batch_size, shuffle=True,
+                                     augmentations=train_augmentations))
     if valid_size:
-        loaders.append(DataLoader(dataset=validset, batch_size=batch_size, shuffle=False))
-    testset = datasetclass(root=root, train=False, download=True)
-    testset = prepare_dataset(testset, invert, augmentations=augment_test and augmentations)
-    loaders.append(DataLoader(dataset=testset, batch_size=batch_size, shuffle=False))
+        loaders.append(TensorBatchLoader(validset, batch_size=batch_size, shuffle=False,
+                                         augmentations=train_augmentations))
+    testset = prepare_dataset(False, invert)
+    loaders.append(TensorBatchLoader(testset, batch_size=batch_size, shuffle=False,
+                                     augmentations=test_augmentations))
     return tuple(loaders)
 
 
+def compile_model(model: torch.nn.Module, compile: str = 'inductor',
+                  cache_dir: Union[str, Path] = 'resources/compile_cache') -> torch.nn.Module:
+    """
+    Compile a model to reduce the Python and operator dispatch overhead of its execution.
+    The returned module shares its parameters with the given model.
+
+    :param model: The model to compile (already compiled models are returned unchanged).
+    :param compile: "inductor" to use `torch.compile` with the inductor backend, or "torchscript"
+        to use `torch.jit.script`.
+    :param cache_dir: Directory in which inductor caches its compiled artifacts across runs. The
+        cache entries are keyed by the traced graph (i.e., the model configuration) as well as the
+        input shapes and data types, so later runs only pay for loading them. The environment
+        variable TORCHINDUCTOR_CACHE_DIR takes precedence if set.
+    :return: The compiled model.
+    """
+    assert compile in ('inductor', 'torchscript'), 'Compilation mode must be either "inductor" or "torchscript".'
+    if hasattr(model, '_orig_mod') or isinstance(model, torch.jit.ScriptModule):
+        return model
+    if compile == 'torchscript':
+        return torch.jit.script(model)
+    assert hasattr(torch, 'compile'), 'Compilation with "inductor" requires PyTorch 2.0 or newer.'
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(Path(cache_dir).absolute()))
+    from torch._inductor import config as inductor_config
+    inductor_config.fx_graph_cache = True
+    return torch.compile(model, backend='inductor')
+
+
+class MetricAccumulator:
+    """
+    Streaming accumulator for the (weighted) mean of scalar tensors. The running sum is kept
+    on the device of the accumulated values and only transferred to the host in `compute`,
+    avoiding a device synchronization for every update.
+    """
+    
+    def __init__(self, device: Union[str, torch.device] = 'cpu'):
+        self.device = torch.device(device)
+        self.reset()
+    
+    def reset(self) -> None:
+        """
+        Discard all accumulated values.
+        """
+        self.total = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.weight = 0
+    
+    def update(self, value: torch.Tensor, weight: Union[int, float] = 1) -> None:
+        """
+        Add a (detached) scalar value with the given weight to the running sum.
+        
+        :param value: Scalar tensor to accumulate.
+        :param weight: Weight of the value, e.g., the number of samples it was averaged over.
+        """
+        self.total += value.detach() * weight
+        self.weight += weight
+    
+    def compute(self) -> float:
+        """
+        Compute the weighted mean of all accumulated values (this synchronizes with the device).
+        
+        :return: Weighted mean as a Python float.
+        """
+        return self.total.item() / self.weight if self.weight else float('nan')
+
+
+# optimizers that can be selected by name in `create_optimizer`
+OPTIMIZERS = {'sgd': torch.optim.SGD, 'adam': torch.optim.Adam, 'adamw': torch.optim.AdamW,
+              'rmsprop': torch.optim.RMSprop}
+
+
+def create_optimizer(model: torch.nn.Module, optimizer: Union[str, type] = 'sgd',
+                     learning_rate: Union[float, int] = 0.01, momentum: Union[float, int] = 0,
+                     weight_decay: float = 0, decay_norm_and_bias: bool = False,
+                     implementation: str = 'foreach') -> torch.optim.Optimizer:
+    """
+    Create an optimizer for the parameters of a model.
+
+    :param model: The model to optimize the parameters of.
+    :param optimizer: Name of the optimizer ("sgd", "adam", "adamw" or "rmsprop") or a
+        torch.optim.Optimizer class.
+    :param learning_rate: Learning rate for the update steps.
+    :param momentum: Momentum term for the update steps (only used by optimizers that have one,
+        e.g., SGD and RMSprop).
+    :param weight_decay: Weight decay (L2 penalty, or decoupled weight decay for AdamW).
+    :param decay_norm_and_bias: Whether to apply weight decay to biases and normalization layers
+        (all parameters with less than two dimensions), which is usually not beneficial.
+    :param implementation: "foreach" to update all parameters with a few multi-tensor operations,
+        "fused" for a single fused kernel (only supported by some optimizers and devices) or
+        "for-loop" to update one parameter after another.
+    :return: The optimizer.
+    """
+    assert implementation in ('for-loop', 'foreach', 'fused'), \
+        'Implementation must be "for-loop", "foreach" or "fused".'
+    cls = OPTIMIZERS[optimizer.lower()] if isinstance(optimizer, str) else optimizer
+    accepted = inspect.signature(cls).parameters
+    params = list(model.parameters())
+    if weight_decay and not decay_norm_and_bias:
+        params = [{'params': [p for p in params if p.dim() > 1]},
+                  {'params': [p for p in params if p.dim() <= 1], 'weight_decay': 0}]
+    kwargs = {'lr': learning_rate}
+    if weight_decay:
+        kwargs['weight_decay'] = weight_decay
+    if 'momentum' in accepted:
+        kwargs['momentum'] = momentum
+    if implementation == 'for-loop':
+        if 'foreach' in accepted:
+            kwargs['foreach'] = False
+    elif implementation in accepted:
+        kwargs[implementation] = True
+    elif implementation == 'fused':
+        raise ValueError(f'{cls.__name__} has no fused implementation.')
+    return cls(params, **kwargs)
+
+
 def run_gradient_descent(model: torch.nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
                          training_set: DataLoader, iterations: int,
                          learning_rate: Union[float, int], momentum: Union[float, int],
                          valid_set: DataLoader = None, use_cuda_if_available: bool = False,
-                         show_batch_progress: bool = False) -> pd.DataFrame:
+                         show_batch_progress: bool = False, log_every: int = None,
+                         compile: str = None, optimizer: Union[str, type] = 'sgd',
+                         weight_decay: float = 0) -> pd.DataFrame:
     """
     Minimize the loss of a model on a dataset.
 
@@ -393,43 +709,57 @@ def run_gradient_descent(model: torch.nn.Module, loss: Callable[[torch.Tensor, t
     :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
     :param show_batch_progress: If True, the progress bar will show the number of batches. If
         False, the progress par will show the number of individual samples.
+    :param log_every: If given, the running training loss is materialized every `log_every` batches
+        and shown in the progress bar. Otherwise, it is only read back at the end of each epoch.
+    :param compile: If given, the forward passes use a compiled version of the model (see
+        `compile_model`), which shares its parameters with the model.
+    :param optimizer: The optimizer to use (see `create_optimizer`), by default SGD. All
+        optimizers use their multi-tensor ("foreach") implementation.
+    :param weight_decay: Weight decay, not applied to biases and normalization layers.
     :return: Loss per epoch.
     """
-    assert isinstance(training_set, DataLoader), 'Invalid dataset (must be PyTorch DataLoader).'
+    assert isinstance(training_set, (DataLoader, TensorBatchLoader)), \
+        'Invalid dataset (must be PyTorch DataLoader or TensorBatchLoader).'
     assert iterations >= 0, 'Iterations must be non-negative.'
     assert (type(learning_rate) in (int, float)) and learning_rate > 0, 'Learning-rate must be > 0.'
     assert (type(momentum) in (int, float)) and momentum >= 0, 'Momentum must be non-negative.'
+    assert log_every is None or log_every >= 1, 'Logging interval must be >= 1.'
     device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
     
     # move model to GPU if available (we already set the device accordingly)
     model = model.to(device)
+    net = compile_model(model, compile) if compile is not None else model
     
     # instantiate optimizer
-    optimizer = torch.optim.SGD(params=model.parameters(), lr=learning_rate, momentum=momentum)
+    optimizer = create_optimizer(model, optimizer, learning_rate, momentum, weight_decay)
     
     # run training loop
     pbar = tqdm(total=len(training_set) if show_batch_progress else len(training_set.dataset))
     assert int(np.ceil(len(training_set.dataset) / training_set.batch_size)) == len(training_set)
     errors = []
     valid_errors = []
+    # training losses are accumulated on the device and only read back when needed
+    train_loss = MetricAccumulator(device)
     for epoch in range(iterations):
         pbar.set_description(f'Epoch {epoch + 1}/{iterations}')
         pbar.reset()
-        errors.append(0)
-        model.train(True)
+        train_loss.reset()
+        net.train(True)
         for inputs, targets in training_set:
             inputs = inputs.to(device)
             targets = targets.to(device)
-            preds = model(inputs)
+            preds = net(inputs)
             error = loss(preds.squeeze(dim=1), targets)
-            errors[-1] += error.item()
+            train_loss.update(error)
             error.backward()
             optimizer.step()
             optimizer.zero_grad()
             pbar.update(1 if show_batch_progress else len(inputs))
-        errors[-1] /= len(training_set)
+            if log_every and train_loss.weight % log_every == 0:
+                pbar.set_postfix(loss=f'{train_loss.compute():.6f}')
+        errors.append(train_loss.compute())
         if valid_set is not None:
-            valid_errors.append(evaluate_model(model, valid_set, loss=loss)['loss'])
+            valid_errors.append(evaluate_model(net, valid_set, loss=loss)['loss'])
         print(f'Epoch {epoch + 1:2d} finished with training loss: {errors[-1]:.6f}' +
               (f' and validation loss: {valid_errors[-1]:.6f}' if valid_set else ''))
     pbar.close()
@@ -441,30 +771,137 @@ def run_gradient_descent(model: torch.nn.Module, loss: Callable[[torch.Tensor, t
     return pd.DataFrame(curves, index=np.arange(1, iterations + 1))
 
 
-def evaluate_model(model: torch.nn.Module, dataset: DataLoader,
+def run_ensemble_gradient_descent(models: Sequence[torch.nn.Module],
+                                  loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                                  training_set: DataLoader, iterations: int,
+                                  learning_rate: Union[float, int], momentum: Union[float, int],
+                                  valid_set: DataLoader = None, use_cuda_if_available: bool = False,
+                                  show_batch_progress: bool = False) -> List[pd.DataFrame]:
+    """
+    Minimize the loss of several models with the same architecture (but, e.g., different initial
+    parameters) on a dataset at once. The parameters of all models are stacked and the models are
+    evaluated in a single vectorized forward and backward pass per batch, so the data is only
+    loaded once. Without dropout, each model follows the same sequence of parameter updates as with
+    `run_gradient_descent` (given the same initial parameters and order of batches); with dropout,
+    the random masks differ. Batch normalization is not supported.
+
+    :param models: The models to optimize the parameters of (updated in place).
+    :param loss: The loss function to minimize.
+    :param training_set: DataLoader for the training data.
+    :param iterations: Amount of epochs (full iterations over the training data).
+    :param learning_rate: Learning rate for the update steps.
+    :param momentum: Momentum term for the update steps.
+    :param valid_set: DataLoader for the validation data (optional).
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :param show_batch_progress: If True, the progress bar will show the number of batches. If
+        False, the progress par will show the number of individual samples.
+    :return: Loss per epoch for each model (as returned by `run_gradient_descent`).
+    """
+    assert isinstance(training_set, (DataLoader, TensorBatchLoader)), \
+        'Invalid dataset (must be PyTorch DataLoader or TensorBatchLoader).'
+    assert len(models) >= 1, 'At least one model is required.'
+    assert iterations >= 0, 'Iterations must be non-negative.'
+    assert (type(learning_rate) in (int, float)) and learning_rate > 0, 'Learning-rate must be > 0.'
+    assert (type(momentum) in (int, float)) and momentum >= 0, 'Momentum must be non-negative.'
+    assert not any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for model in models for m in model.modules()), \
+        'Batch normalization is not supported for ensembles.'
+    from torch.func import stack_module_state, functional_call, vmap
+    device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
+    
+    # stack the parameters of all models along a new first dimension
+    models = [model.to(device) for model in models]
+    params, buffers = stack_module_state(models)
+    base = copy.deepcopy(models[0]).to('meta')
+    
+    def ensemble_loss(params, buffers, inputs, targets):
+        preds = functional_call(base, (params, buffers), (inputs,))
+        return loss(preds.squeeze(dim=1), targets)
+    
+    # one loss per model, all models get the same batch (dropout masks differ between models)
+    ensemble_loss = vmap(ensemble_loss, in_dims=(0, 0, None, None), randomness='different')
+    
+    def evaluate(dataset):
+        total = torch.zeros(len(models), dtype=torch.float64, device=device)
+        base.train(False)
+        with torch.no_grad():
+            for inputs, targets in dataset:
+                total += ensemble_loss(params, buffers, inputs.to(device), targets.to(device)) * len(inputs)
+        return (total / len(dataset.dataset)).tolist()
+    
+    # instantiate optimizer (SGD works element-wise, so each model is updated independently)
+    optimizer = torch.optim.SGD(params=params.values(), lr=learning_rate, momentum=momentum)
+    
+    # run training loop
+    pbar = tqdm(total=len(training_set) if show_batch_progress else len(training_set.dataset))
+    errors = []
+    valid_errors = []
+    for epoch in range(iterations):
+        pbar.set_description(f'Epoch {epoch + 1}/{iterations}')
+        pbar.reset()
+        # training losses (mean of the batch losses, as in `run_gradient_descent`) are accumulated
+        # on the device and only read back at the end of the epoch
+        train_losses = [MetricAccumulator(device) for _ in models]
+        base.train(True)
+        for inputs, targets in training_set:
+            inputs = inputs.to(device)
+            targets = targets.to(device)
+            error = ensemble_loss(params, buffers, inputs, targets)
+            for train_loss, model_error in zip(train_losses, error.detach()):
+                train_loss.update(model_error)
+            # the models are independent, so the gradient of the sum is the gradient of each loss
+            error.sum().backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            pbar.update(1 if show_batch_progress else len(inputs))
+        errors.append([train_loss.compute() for train_loss in train_losses])
+        if valid_set is not None:
+            valid_errors.append(evaluate(valid_set))
+        print(f'Epoch {epoch + 1:2d} finished with mean training loss: {np.mean(errors[-1]):.6f}' +
+              (f' and mean validation loss: {np.mean(valid_errors[-1]):.6f}' if valid_set else ''))
+    pbar.close()
+    
+    # copy the trained parameters back into the models
+    with torch.no_grad():
+        for index, model in enumerate(models):
+            for name, tensor in itertools.chain(model.named_parameters(), model.named_buffers()):
+                tensor.copy_((params if name in params else buffers)[name][index])
+    
+    # return training curves
+    results = []
+    for index in range(len(models)):
+        curves = {'training loss': np.asarray([epoch_errors[index] for epoch_errors in errors])}
+        if valid_set is not None:
+            curves['validation loss'] = np.asarray([epoch_errors[index] for epoch_errors in valid_errors])
+        results.append(pd.DataFrame(curves, index=np.arange(1, iterations + 1)))
+    return results
+
+
+def evaluate_model(model: torch.nn.Module, dataset: DataLoader, *, compile: str = None,
                    **losses: Callable[[torch.Tensor, torch.Tensor], torch.Tensor]) -> Dict[str, float]:
     """
     Computes one or more loss functions for a model on a dataset.
     
     :param model: The model to optimize the parameters of.
     :param dataset: DataLoader for the evaluation data.
+    :param compile: If given, evaluate a compiled version of the model (see `compile_model`).
     :param losses: The loss functions to compute.
     :return: A float for each given loss function.
     """
-    device = next(model.parameters()).device
+    device = next(model.parameters(), torch.empty(0)).device
+    if compile is not None:
+        model = compile_model(model, compile)
     
-    results = {name: 0.0 for name in losses}
+    # one accumulator per loss function, all fed from a single forward pass per batch
+    results = {name: MetricAccumulator(device) for name in losses}
     model.train(False)
-    for inputs, targets in dataset:
-        inputs = inputs.to(device)
-        targets = targets.to(device)
-        for name, loss in losses.items():
-            with torch.no_grad():
-                preds = model(inputs)
-                results[name] += loss(preds.squeeze(dim=1), targets).item() * len(inputs)
-    results = {name: loss / len(dataset.dataset)
-               for name, loss in results.items()}
-    return results
+    with torch.no_grad():
+        for inputs, targets in dataset:
+            inputs = inputs.to(device)
+            targets = targets.to(device)
+            preds = model(inputs).squeeze(dim=1)
+            for name, loss in losses.items():
+                results[name].update(loss(preds, targets), weight=len(inputs))
+    return {name: accumulator.compute() for name, accumulator in results.items()}
 
 
 def multiclass_accuracy(preds: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
@@ -479,6 +916,96 @@ def multiclass_accuracy(preds: torch.Tensor, targets: torch.Tensor) -> torch.Ten
     return (preds == targets).float().mean()
 
 
+def measure_latency(model: torch.nn.Module, inputs: torch.Tensor, repeats: int = 20, warmup: int = 3) -> float:
+    """
+    Measure the median time of a forward pass of a model on the CPU (the median is robust to
+    outliers, e.g., from other processes, and the same statistic as in the other units).
+    
+    :param model: The model to time.
+    :param inputs: The batch of inputs to pass through the model.
+    :param repeats: Number of timed forward passes.
+    :param warmup: Number of untimed forward passes before timing.
+    :return: Median latency in seconds.
+    """
+    timings = []
+    with torch.no_grad():
+        for step in range(warmup + repeats):
+            start = time.perf_counter()
+            model(inputs)
+            if step >= warmup:
+                timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def quantize_model(model: torch.nn.Module, mode: str = 'dynamic', calibration_set: DataLoader = None,
+                   num_calibration_batches: int = 10) -> torch.nn.Module:
+    """
+    Quantize a (trained) model to 8-bit integers for faster inference on the CPU. The given model
+    is not modified, and the quantized model cannot be trained any more.
+
+    :param model: The model to quantize.
+    :param mode: "dynamic" to quantize the weights of linear layers ahead of time and their
+        activations on the fly, or "static" to quantize all linear layers with activation ranges
+        calibrated on `calibration_set`.
+    :param calibration_set: DataLoader to take calibration batches from (required for "static").
+    :param num_calibration_batches: Number of batches used for calibration.
+    :return: The quantized model (on the CPU).
+    """
+    assert mode in ('dynamic', 'static'), 'Quantization mode must be either "dynamic" or "static".'
+    assert mode != 'static' or calibration_set is not None, 'Static quantization requires a calibration set.'
+    from torch.ao import quantization
+    from torch.ao.quantization import quantize_fx
+    # use the best available backend for x86 CPUs
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = 'x86' if 'x86' in engines else 'fbgemm'
+    
+    model = copy.deepcopy(model).cpu()
+    model.train(False)
+    if mode == 'dynamic':
+        return quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    # graph mode quantization inserts the (de)quantization steps around the layers automatically
+    calibration_batches = [inputs for inputs, _ in itertools.islice(calibration_set, num_calibration_batches)]
+    qconfig_mapping = quantization.get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = quantize_fx.prepare_fx(model, qconfig_mapping, example_inputs=(calibration_batches[0].cpu(),))
+    with torch.no_grad():
+        for inputs in calibration_batches:
+            prepared(inputs.cpu())
+    return quantize_fx.convert_fx(prepared)
+
+
+def quantization_report(model: torch.nn.Module, dataset: DataLoader, calibration_set: DataLoader,
+                        modes: Tuple[str, ...] = ('dynamic', 'static'),
+                        num_calibration_batches: int = 10) -> pd.DataFrame:
+    """
+    Compare the accuracy, latency and size of a model and its quantized versions on the CPU.
+
+    :param model: The (trained) model to quantize.
+    :param dataset: DataLoader for the evaluation data (its first batch is used to measure latency).
+    :param calibration_set: DataLoader to take calibration batches from (see `quantize_model`).
+    :param modes: The quantization modes to compare.
+    :param num_calibration_batches: Number of batches used for calibration.
+    :return: Accuracy, latency per batch, speedup and size of the parameters (columns) for the
+        original model and each quantization mode (rows).
+    """
+    models = {'float32': copy.deepcopy(model).cpu()}
+    for mode in modes:
+        models[mode] = quantize_model(model, mode, calibration_set, num_calibration_batches=num_calibration_batches)
+    inputs, _ = next(iter(dataset))
+    inputs = inputs.cpu()
+    results = {}
+    for name, candidate in models.items():
+        candidate.train(False)
+        buffer = io.BytesIO()
+        torch.save(candidate.state_dict(), buffer)
+        results[name] = {'accuracy': evaluate_model(candidate, dataset, accuracy=multiclass_accuracy)['accuracy'],
+                         'latency ms': measure_latency(candidate, inputs) * 1000,
+                         'size MB': buffer.getbuffer().nbytes / 2 ** 20}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results['speedup'] = results['latency ms'].iloc[0] / results['latency ms']
+    return results
+
+
 def visualize_model(sizes: List[int], diameter: float = 0.1, hdist: float = 0.15, vdist: float = 0.5, dpi=180):
     """
     Draw a fully-connected neural network model.
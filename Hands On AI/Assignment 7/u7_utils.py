@@ -13,16 +13,31 @@ material, no matter whether as a whole or in parts, no matter whether in printed
 or in electronic form, requires explicit prior acceptance of the authors.
 """
 import base64
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import http.server
+import inspect
+import io
+import itertools
+import json
+import math
 import os
+import queue
 import random
+import sqlite3
 import sys
+import threading
+import time
 import urllib.request
 import warnings
 from collections import OrderedDict
 from packaging.version import Version
 from IPython.core.display import HTML
 from pathlib import Path
-from typing import Callable, Union, Dict
+from typing import Callable, Union, Dict, Tuple
 from urllib.error import URLError
 
 import fastai
@@ -30,16 +45,18 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import PIL.Image
 import seaborn as sns
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import torchvision
 import torchvision.models as vision_models
 import tqdm as tqdm_
 # Import from ".all" to automatically import intermediate modules (otherwise, i.e., importing
 # everything from their respective modules, it somehow does not work properly)
 from fastai.vision.all import Learner, vision_learner, verify_image, error_rate, ClassificationInterpretation,\
-    imagenet_stats, ImageDataLoaders, Resize, RandomResizedCrop, aug_transforms, Normalize
+    imagenet_stats, ImageDataLoaders, Resize, RandomResizedCrop, aug_transforms, Normalize, RandTransform
 from fastai.data.load import DataLoader as FastaiDataLoader
 from torch.utils.data import DataLoader as TorchDataLoader
 from tqdm.autonotebook import tqdm
@@ -146,6 +163,48 @@ def set_seed(seed: int = 42) -> None:
     torch.backends.cudnn.benchmark = False
 
 
+def get_rng_states(loader: Union[TorchDataLoader, FastaiDataLoader] = None) -> Dict:
+    """
+    Capture the states of all underlying (pseudo) random number sources, e.g., to store them
+    in a checkpoint. All states only consist of tensors and plain Python types.
+
+    :param loader: Optional data loader whose own random number generator (if any) is included.
+    :return: The random number generator states.
+    """
+    np_state = np.random.get_state()
+    states = {'python': random.getstate(),
+              'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64))) + tuple(np_state[2:]),
+              'torch': torch.random.get_rng_state(),
+              'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+              'loader': None}
+    if isinstance(getattr(loader, 'rng', None), random.Random):
+        # fastai DataLoaders shuffle with their own generator
+        states['loader'] = loader.rng.getstate()
+    elif getattr(loader, 'generator', None) is not None:
+        states['loader'] = loader.generator.get_state()
+    return states
+
+
+def set_rng_states(states: Dict, loader: Union[TorchDataLoader, FastaiDataLoader] = None) -> None:
+    """
+    Restore random number generator states captured with `get_rng_states`.
+
+    :param states: The random number generator states.
+    :param loader: Optional data loader whose own random number generator (if any) is restored.
+    """
+    random.setstate(states['python'])
+    np_state = states['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32)) + tuple(np_state[2:]))
+    torch.random.set_rng_state(states['torch'])
+    if states['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+    if states['loader'] is not None:
+        if isinstance(getattr(loader, 'rng', None), random.Random):
+            loader.rng.setstate(states['loader'])
+        elif getattr(loader, 'generator', None) is not None:
+            loader.generator.set_state(states['loader'])
+
+
 def download_all_images(path: Path, overwrite: bool = False, try_failed: bool = False,
                         failed_file_name: str = "failed.txt") -> None:
     """
@@ -325,7 +384,8 @@ def evaluate_classifier(learner: Learner) -> ClassificationInterpretation:
 
 
 def create_cnn(num_classes: int, num_layers: int = 5, dropout: float = 0, batchnorm: bool = False,
-               residuals: bool = False, pretrained: bool = False) -> nn.Module:
+               residuals: bool = False, pretrained: bool = False, checkpointing: str = None,
+               compile: str = None) -> nn.Module:
     """
     Create a CNN classification model.
 
@@ -335,6 +395,9 @@ def create_cnn(num_classes: int, num_layers: int = 5, dropout: float = 0, batchn
     :param batchnorm: Whether to use batch normalization.
     :param residuals: Whether to use residual connections.
     :param pretrained: Whether to use pretrained weights (and freeze them).
+    :param checkpointing: If given, enable activation checkpointing for the residual stages with
+        this granularity (see `enable_checkpointing`; ResNets only).
+    :param compile: If given, compile the model with this mode (see `compile_model`).
     :return: A PyTorch neural network model.
     """
 
@@ -428,16 +491,1268 @@ def create_cnn(num_classes: int, num_layers: int = 5, dropout: float = 0, batchn
         add_biases(model)
     if not residuals and num_layers != 5:
         remove_residuals(model)
+    if checkpointing is not None:
+        enable_checkpointing(model, checkpointing)
+
+    if compile is not None:
+        model = compile_model(model, compile)
+
+    return model
+
+
+def compile_model(model: nn.Module, compile: str = 'inductor',
+                  cache_dir: Union[str, Path] = 'resources/compile_cache') -> nn.Module:
+    """
+    Compile a model to reduce the Python and operator dispatch overhead of its execution.
+    The returned module shares its parameters with the given model.
+
+    :param model: The model to compile (already compiled models are returned unchanged).
+    :param compile: "inductor" to use `torch.compile` with the inductor backend, or "torchscript"
+        to use `torch.jit.script`.
+    :param cache_dir: Directory in which inductor caches its compiled artifacts across runs. The
+        cache entries are keyed by the traced graph (i.e., the model configuration) as well as the
+        input shapes and data types, so later runs only pay for loading them. The environment
+        variable TORCHINDUCTOR_CACHE_DIR takes precedence if set.
+    :return: The compiled model.
+    """
+    assert compile in ('inductor', 'torchscript'), 'Compilation mode must be either "inductor" or "torchscript".'
+    if hasattr(model, '_orig_mod') or isinstance(model, torch.jit.ScriptModule):
+        return model
+    if compile == 'torchscript':
+        return torch.jit.script(model)
+    assert hasattr(torch, 'compile'), 'Compilation with "inductor" requires PyTorch 2.0 or newer.'
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(Path(cache_dir).absolute()))
+    from torch._inductor import config as inductor_config
+    inductor_config.fx_graph_cache = True
+    return torch.compile(model, backend='inductor')
+
+
+@contextlib.contextmanager
+def _frozen_batchnorm_statistics(modules: list):
+    # keep the batch normalization layers in the given modules from updating their running statistics
+    layers = [m for module in modules for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(m.momentum, None if m.num_batches_tracked is None else m.num_batches_tracked.clone()) for m in layers]
+    for m in layers:
+        m.momentum = 0.0  # running statistics are kept as they are
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(layers, saved):
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+class CheckpointedSequential(nn.Sequential):
+    """
+    Sequential container that, during training, only keeps the inputs of each segment of
+    `segment_size` consecutive layers for the backward pass and recomputes the activations inside
+    the segments (activation checkpointing). Batch normalization layers only update their running
+    statistics in the forward pass, not when recomputed, so training gives the same results as
+    without checkpointing. The layers keep their names, so state dicts remain compatible with the
+    original container.
+    """
+    
+    def __init__(self, sequential: nn.Sequential, segment_size: int):
+        super().__init__(OrderedDict(sequential.named_children()))
+        assert segment_size >= 1, 'Segment size must be >= 1.'
+        self.segment_size = segment_size
+    
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not (self.training and torch.is_grad_enabled()):
+            return super().forward(x)
+        layers = list(self)
+        for start in range(0, len(layers), self.segment_size):
+            # the first call of a segment is the forward pass, further calls recompute the
+            # activations for the backward pass
+            calls = []
+            
+            def run_segment(x, segment=layers[start:start + self.segment_size], calls=calls):
+                with _frozen_batchnorm_statistics(segment) if calls else contextlib.nullcontext():
+                    for layer in segment:
+                        x = layer(x)
+                calls.append(None)
+                return x
+            x = torch.utils.checkpoint.checkpoint(run_segment, x, use_reentrant=False)
+        return x
+
+
+def enable_checkpointing(model: nn.Module, granularity: str = 'block',
+                         stages: Tuple[int, ...] = (1, 2, 3, 4)) -> nn.Module:
+    """
+    Enable activation checkpointing for residual stages of a ResNet (see `create_cnn`, also
+    without residual connections), trading computation for memory: activations inside the
+    checkpointed segments are recomputed during the backward pass instead of being stored.
+
+    :param model: The ResNet model to modify (in place).
+    :param granularity: Segment size within each stage: "stage" (one segment per stage, least
+        memory, largest recomputation), "sqrt" (about the square root of the number of blocks
+        per segment) or "block" (one segment per residual block).
+    :param stages: The stages (1 to 4) to checkpoint.
+    :return: The modified model.
+    """
+    assert isinstance(model, vision_models.ResNet), 'Activation checkpointing is only supported for ResNets.'
+    assert granularity in ('stage', 'sqrt', 'block'), 'Granularity must be "stage", "sqrt" or "block".'
+    for stage in stages:
+        name = 'layer%d' % stage
+        layer = getattr(model, name)
+        if isinstance(layer, CheckpointedSequential):
+            layer = nn.Sequential(OrderedDict(layer.named_children()))
+        segment_size = {'stage': len(layer), 'sqrt': math.ceil(math.sqrt(len(layer))), 'block': 1}[granularity]
+        setattr(model, name, CheckpointedSequential(layer, segment_size))
+    return model
+
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    """
+    Fold batch normalization layers into the directly preceding convolutional or linear layers
+    (in place). This is only valid for inference, so the model is switched to evaluation mode.
+    Only nn.Sequential containers and torchvision ResNets and their blocks are considered, as
+    their submodules are executed in the order they are registered.
+
+    :param model: The model to modify.
+    :return: The modified model.
+    """
+    containers = (nn.Sequential, vision_models.ResNet, vision_models.resnet.BasicBlock,
+                  vision_models.resnet.Bottleneck)
+    fuse_linear_bn_eval = getattr(torch.nn.utils, 'fuse_linear_bn_eval', None)  # PyTorch 2.0+
+    model.train(False)
+    for module in list(model.modules()):
+        if not isinstance(module, containers):
+            continue
+        children = list(module.named_children())
+        for (name, layer), (bn_name, bn) in zip(children, children[1:]):
+            if isinstance(layer, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                fused = torch.nn.utils.fuse_conv_bn_eval(layer, bn)
+            elif isinstance(layer, nn.Linear) and isinstance(bn, nn.BatchNorm1d) and fuse_linear_bn_eval:
+                fused = fuse_linear_bn_eval(layer, bn)
+            else:
+                continue
+            setattr(module, name, fused)
+            setattr(module, bn_name, nn.Identity())
+    return model
+
+
+class ChannelsLast(nn.Module):
+    """
+    Wrapper that runs a model on its inputs in channels-last (NHWC) memory format.
+    """
+    
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+    
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def measure_latency(model: nn.Module, inputs: torch.Tensor, repeats: int = 20, warmup: int = 3) -> float:
+    """
+    Measure the median duration of a forward pass without gradient computation (the median is
+    robust to outliers, e.g., from other processes, and the same statistic as in the other units).
+
+    :param model: The model to measure (it should already be in evaluation mode).
+    :param inputs: The batch to pass to the model (already on the model's device).
+    :param repeats: Number of timed forward passes.
+    :param warmup: Number of untimed forward passes before the measurement.
+    :return: Median seconds per forward pass.
+    """
+    timings = []
+    with torch.no_grad():
+        for step in range(warmup + repeats):
+            start = time.perf_counter()
+            model(inputs)
+            if inputs.is_cuda:
+                torch.cuda.synchronize()
+            if step >= warmup:
+                timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def optimize_for_inference(model: nn.Module, example_inputs: torch.Tensor, batchnorm: bool = True,
+                           channels_last: bool = True, freeze: bool = True, check: bool = True,
+                           rtol: float = 1e-3, atol: float = 1e-4) -> Tuple[nn.Module, pd.DataFrame]:
+    """
+    Create a faster version of a (trained) model for inference, e.g., a model from `create_cnn`.
+    The returned module can be used in place of the model, e.g., with `evaluate_model`, but it
+    cannot be trained any more. The given model itself is not modified.
+
+    :param model: The model to optimize.
+    :param example_inputs: A batch of inputs, used for tracing, checking and timing the models.
+    :param batchnorm: Whether to fold batch normalization layers into the preceding layers.
+    :param channels_last: Whether to run the model in channels-last (NHWC) memory format, for which
+        the CPU convolution kernels are faster.
+    :param freeze: Whether to trace and freeze the model with TorchScript and apply its inference
+        optimizations, which fuse convolutions with subsequent ReLUs (and additions) where possible.
+    :param check: Whether to check that the outputs match those of the original model.
+    :param rtol: Relative tolerance for the check.
+    :param atol: Absolute tolerance for the check.
+    :return: The optimized model, and the latency per batch, speedup and maximum absolute output
+        difference (columns) of the original and optimized model (rows).
+    """
+    device = next(model.parameters()).device
+    example_inputs = example_inputs.to(device)
+    was_training = model.training
+    model.train(False)
+    
+    optimized = copy.deepcopy(model)
+    if batchnorm:
+        fold_batchnorm(optimized)
+    if channels_last:
+        optimized = ChannelsLast(optimized)
+    optimized.train(False)
+    if freeze:
+        with torch.no_grad():
+            optimized = torch.jit.optimize_for_inference(torch.jit.trace(optimized, example_inputs))
+    
+    with torch.no_grad():
+        expected = model(example_inputs)
+        actual = optimized(example_inputs)
+    difference = (actual.float() - expected.float()).abs().max().item()
+    if check:
+        assert torch.allclose(actual.float(), expected.float(), rtol=rtol, atol=atol), \
+            f'Optimized model deviates from the original model (maximum absolute difference {difference:.2e}).'
+    latencies = [measure_latency(model, example_inputs), measure_latency(optimized, example_inputs)]
+    model.train(was_training)
+    
+    report = pd.DataFrame({'latency ms': np.asarray(latencies) * 1000, 'max abs difference': [0, difference]},
+                          index=['original', 'optimized'])
+    report['speedup'] = report['latency ms'].iloc[0] / report['latency ms']
+    return optimized, report
+
+
+def quantize_model(model: nn.Module, mode: str = 'dynamic',
+                   calibration_set: Union[TorchDataLoader, FastaiDataLoader] = None,
+                   num_calibration_batches: int = 10) -> nn.Module:
+    """
+    Quantize a (trained) model to 8-bit integers for faster inference on the CPU. The given model
+    is not modified, and the quantized model cannot be trained any more.
+
+    :param model: The model to quantize.
+    :param mode: "dynamic" to quantize the weights of linear layers ahead of time and their
+        activations on the fly, or "static" to quantize all supported layers (including
+        convolutions) with activation ranges calibrated on `calibration_set`.
+    :param calibration_set: DataLoader to take calibration batches from (required for "static").
+    :param num_calibration_batches: Number of batches used for calibration.
+    :return: The quantized model (on the CPU).
+    """
+    assert mode in ('dynamic', 'static'), 'Quantization mode must be either "dynamic" or "static".'
+    assert mode != 'static' or calibration_set is not None, 'Static quantization requires a calibration set.'
+    from torch.ao import quantization
+    from torch.ao.quantization import quantize_fx
+    # use the best available backend for x86 CPUs
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = 'x86' if 'x86' in engines else 'fbgemm'
+    
+    model = copy.deepcopy(model).cpu()
+    model.train(False)
+    if mode == 'dynamic':
+        return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    
+    # graph mode quantization also handles functional operations such as residual additions
+    calibration_batches = [inputs for inputs, _ in itertools.islice(calibration_set, num_calibration_batches)]
+    qconfig_mapping = quantization.get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = quantize_fx.prepare_fx(model, qconfig_mapping, example_inputs=(calibration_batches[0].cpu(),))
+    with torch.no_grad():
+        for inputs in calibration_batches:
+            prepared(inputs.cpu())
+    return quantize_fx.convert_fx(prepared)
+
+
+def quantization_report(model: nn.Module, dataset: Union[TorchDataLoader, FastaiDataLoader],
+                        calibration_set: Union[TorchDataLoader, FastaiDataLoader],
+                        modes: Tuple[str, ...] = ('dynamic', 'static'),
+                        num_calibration_batches: int = 10) -> pd.DataFrame:
+    """
+    Compare the accuracy, latency and size of a model and its quantized versions on the CPU.
+
+    :param model: The (trained) model to quantize.
+    :param dataset: DataLoader for the evaluation data (its first batch is used to measure latency).
+    :param calibration_set: DataLoader to take calibration batches from (see `quantize_model`).
+    :param modes: The quantization modes to compare.
+    :param num_calibration_batches: Number of batches used for calibration.
+    :return: Accuracy, latency per batch, speedup and size of the parameters (columns) for the
+        original model and each quantization mode (rows).
+    """
+    models = {'float32': copy.deepcopy(model).cpu()}
+    for mode in modes:
+        models[mode] = quantize_model(model, mode, calibration_set, num_calibration_batches=num_calibration_batches)
+    inputs, _ = next(iter(dataset))
+    results = {}
+    for name, candidate in models.items():
+        candidate.train(False)
+        buffer = io.BytesIO()
+        torch.save(candidate.state_dict(), buffer)
+        results[name] = {'accuracy': evaluate_model(candidate, dataset, accuracy=multiclass_accuracy)['accuracy'],
+                         'latency ms': measure_latency(candidate, inputs.cpu()) * 1000,
+                         'size MB': buffer.getbuffer().nbytes / 2 ** 20}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results['speedup'] = results['latency ms'].iloc[0] / results['latency ms']
+    return results
+
 
+def _prunable_groups(model: nn.Module) -> list:
+    # find (producer, batchnorm or None, consumer) triples where the output channels of the producer
+    # (Conv2d or Linear) only pass through channel-wise layers before being consumed by the next
+    # Conv2d or Linear layer, so they can be removed from both without changing anything else
+    passthrough = (nn.ReLU, nn.MaxPool2d, nn.AvgPool2d, nn.AdaptiveAvgPool2d, nn.Dropout, nn.Identity,
+                   nn.Flatten)
+    groups = []
+    seen = set()
+    
+    def leaves(module):
+        # flatten nested nn.Sequential containers, as they are executed one after another
+        for child in module.children():
+            if type(child) is nn.Sequential:
+                yield from leaves(child)
+            else:
+                yield child
+    
+    def is_producer(layer):
+        return isinstance(layer, nn.Linear) or (isinstance(layer, nn.Conv2d) and layer.groups == 1)
+    
+    for module in model.modules():
+        if isinstance(module, (vision_models.resnet.BasicBlock, vision_models.resnet.Bottleneck)):
+            # only the channels inside residual blocks, their outputs are tied to the residual path
+            names = ['conv1', 'conv2', 'conv3'] if hasattr(module, 'conv3') else ['conv1', 'conv2']
+            for producer, bn, consumer in zip(names, ['bn1', 'bn2'], names[1:]):
+                producer, consumer = getattr(module, producer), getattr(module, consumer)
+                bn = getattr(module, bn)
+                if is_producer(producer) and id(producer) not in seen:
+                    seen.add(id(producer))
+                    groups.append((producer, bn if isinstance(bn, nn.BatchNorm2d) else None, consumer))
+        elif type(module) is nn.Sequential:
+            last = None
+            for layer in leaves(module):
+                if isinstance(layer, (nn.Conv2d, nn.Linear)):
+                    if last is not None and id(last[0]) not in seen:
+                        out_features = last[0].weight.shape[0]
+                        in_features = layer.in_channels if isinstance(layer, nn.Conv2d) else layer.in_features
+                        # a Linear consumer only works after global pooling to one value per channel
+                        if in_features == out_features:
+                            seen.add(id(last[0]))
+                            groups.append((last[0], last[1], layer))
+                    last = [layer, None] if is_producer(layer) else None
+                elif isinstance(layer, (nn.BatchNorm1d, nn.BatchNorm2d)) and last is not None and last[1] is None:
+                    last[1] = layer
+                elif not isinstance(layer, passthrough):
+                    last = None
+    return groups
+
+
+def _channel_importance(groups: list, model: nn.Module, criterion: str,
+                        dataset: Union[TorchDataLoader, FastaiDataLoader],
+                        loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor], num_batches: int) -> list:
+    # importance of each output channel of each producer (higher is more important)
+    if criterion == 'l1':
+        return [producer.weight.detach().abs().flatten(1).sum(1) for producer, _, _ in groups]
+    
+    # first-order Taylor expansion of the loss: |sum of activation * gradient| per channel
+    scores = [0] * len(groups)
+    hooks = []
+    
+    def hook(index):
+        def forward_hook(module, inputs, output):
+            def backward_hook(grad):
+                contribution = output.detach() * grad
+                if contribution.dim() > 2:
+                    # sum over the spatial positions of each channel
+                    contribution = contribution.flatten(2).sum(2)
+                scores[index] = scores[index] + contribution.abs().sum(0)
+            if output.requires_grad:
+                output.register_hook(backward_hook)
+        return forward_hook
+    
+    for index, (producer, bn, _) in enumerate(groups):
+        # measure after batch normalization, which rescales the channels
+        hooks.append((bn or producer).register_forward_hook(hook(index)))
+    device = next(model.parameters()).device
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    training = model.training
+    try:
+        # gradients with respect to the activations are needed even for frozen layers
+        for p in model.parameters():
+            p.requires_grad_(True)
+        model.train(False)
+        processed = 0
+        for inputs, targets in itertools.islice(dataset, num_batches):
+            model.zero_grad()
+            loss(model(inputs.to(device)).squeeze(dim=1), targets.to(device)).backward()
+            processed += 1
+        assert processed > 0, 'The "taylor" criterion requires at least one batch of data.'
+    finally:
+        for handle in hooks:
+            handle.remove()
+        for p, flag in zip(model.parameters(), requires_grad):
+            p.requires_grad_(flag)
+        model.zero_grad()
+        model.train(training)
+    return [score.detach() for score in scores]
+
+
+def _select(layer: nn.Module, name: str, keep: torch.Tensor, dim: int) -> None:
+    # replace a parameter or buffer with the kept channels along `dim`
+    tensor = getattr(layer, name)
+    if tensor is None:
+        return
+    selected = tensor.detach().index_select(dim, keep).clone()
+    if isinstance(tensor, nn.Parameter):
+        setattr(layer, name, nn.Parameter(selected, requires_grad=tensor.requires_grad))
+    else:
+        setattr(layer, name, selected)
+
+
+def prune_channels(model: nn.Module, sparsity: float, criterion: str = 'l1',
+                   dataset: Union[TorchDataLoader, FastaiDataLoader] = None,
+                   loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor] = None,
+                   num_batches: int = 10) -> nn.Module:
+    """
+    Structured pruning: remove the least important output channels of convolutional and linear
+    layers (see `create_cnn`), physically shrinking their weights, those of the following batch
+    normalization layer and the input channels of the next layer. The result is a smaller dense
+    model; the given model is not modified. In ResNets with residual connections, only the
+    channels inside the residual blocks are pruned, as the others are tied to the residual path.
+
+    :param model: The model to prune.
+    :param sparsity: Fraction of channels to remove from each prunable layer (at least one channel
+        is always kept).
+    :param criterion: How to rate the importance of the channels: "l1" for the L1 norm of their
+        weights, or "taylor" for the first-order Taylor estimate of their effect on the loss
+        (requires `dataset` and `loss`).
+    :param dataset: DataLoader to take batches from for the "taylor" criterion.
+    :param loss: The loss function for the "taylor" criterion.
+    :param num_batches: Number of batches for the "taylor" criterion.
+    :return: The pruned model.
+    """
+    assert 0 <= sparsity < 1, 'Sparsity must be in [0, 1).'
+    assert criterion in ('l1', 'taylor'), 'Pruning criterion must be either "l1" or "taylor".'
+    assert criterion != 'taylor' or (dataset is not None and loss is not None), \
+        'The "taylor" criterion requires a dataset and a loss function.'
+    model = copy.deepcopy(model)
+    groups = _prunable_groups(model)
+    importances = _channel_importance(groups, model, criterion, dataset, loss, num_batches)
+    for (producer, bn, consumer), importance in zip(groups, importances):
+        num_keep = max(1, int(round(len(importance) * (1 - sparsity))))
+        keep = importance.argsort(descending=True)[:num_keep].sort().values.to(producer.weight.device)
+        _select(producer, 'weight', keep, 0)
+        _select(producer, 'bias', keep, 0)
+        if isinstance(producer, nn.Conv2d):
+            producer.out_channels = num_keep
+        else:
+            producer.out_features = num_keep
+        if bn is not None:
+            for name in ('weight', 'bias', 'running_mean', 'running_var'):
+                _select(bn, name, keep, 0)
+            bn.num_features = num_keep
+        _select(consumer, 'weight', keep, 1)
+        if isinstance(consumer, nn.Conv2d):
+            consumer.in_channels = num_keep
+        else:
+            consumer.in_features = num_keep
     return model
 
 
+def export_model(model: nn.Module, example_inputs: torch.Tensor, path: Union[str, Path]) -> None:
+    """
+    Save a model as TorchScript, which can be loaded with `torch.jit.load` without the code that
+    created it (e.g., a pruned model whose layer sizes differ from `create_cnn`).
+
+    :param model: The model to export (in evaluation mode).
+    :param example_inputs: A batch of inputs to trace the model with.
+    :param path: The file to write.
+    """
+    model.train(False)
+    device = next(model.parameters(), torch.empty(0)).device
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_inputs.to(device))
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(traced, str(path))
+
+
+def pruning_sweep(model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                  training_set: Union[TorchDataLoader, FastaiDataLoader],
+                  valid_set: Union[TorchDataLoader, FastaiDataLoader],
+                  sparsities: Tuple[float, ...] = (0, 0.25, 0.5, 0.75), criterion: str = 'l1',
+                  iterations: int = 0, learning_rate: Union[float, int] = 0.01, momentum: Union[float, int] = 0.9,
+                  **kwargs) -> Tuple[Dict[float, nn.Module], pd.DataFrame]:
+    """
+    Prune a (trained) model to different sparsities (see `prune_channels`), optionally fine-tune
+    each pruned model, and compare their size, accuracy and CPU latency.
+
+    :param model: The model to prune.
+    :param loss: The loss function for fine-tuning (and the "taylor" criterion).
+    :param training_set: DataLoader for the fine-tuning (and "taylor" criterion) data.
+    :param valid_set: DataLoader for the evaluation data (its first batch is used to measure latency).
+    :param sparsities: The fractions of channels to remove.
+    :param criterion: How to rate the importance of the channels: "l1" or "taylor".
+    :param iterations: Number of fine-tuning epochs with `run_gradient_descent` (0 for none).
+    :param learning_rate: Learning rate for fine-tuning.
+    :param momentum: Momentum term for fine-tuning.
+    :param kwargs: Further arguments for `run_gradient_descent`.
+    :return: The pruned models by sparsity, and their number of parameters, accuracy, latency per
+        batch and speedup (columns) by sparsity (rows).
+    """
+    inputs, _ = next(iter(valid_set))
+    models = {}
+    results = {}
+    for sparsity in sparsities:
+        pruned = prune_channels(model, sparsity, criterion, dataset=training_set, loss=loss)
+        if iterations:
+            run_gradient_descent(pruned, loss, training_set, iterations, learning_rate, momentum, **kwargs)
+        models[sparsity] = pruned
+        cpu_model = copy.deepcopy(pruned).cpu()
+        cpu_model.train(False)
+        results[sparsity] = {'parameters': sum(p.numel() for p in pruned.parameters()),
+                             'accuracy': evaluate_model(pruned, valid_set, accuracy=multiclass_accuracy)['accuracy'],
+                             'latency ms': measure_latency(cpu_model, inputs.cpu()) * 1000}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results.index.name = 'sparsity'
+    results['speedup'] = results['latency ms'].iloc[0] / results['latency ms']
+    return models, results
+
+
+# data types for the supported `precision` settings (None means no autocasting)
+AUTOCAST_DTYPES = {'float32': None, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+
+def precision_context(device: Union[str, torch.device], precision: str = 'float32') -> torch.autocast:
+    """
+    Create an autocast context that runs eligible operations in the given precision.
+
+    :param device: The device the computations run on.
+    :param precision: One of "float32" (no autocasting), "bfloat16" or "float16" (CUDA only).
+    :return: A context manager (disabled for "float32").
+    """
+    device = torch.device(device)
+    assert precision in AUTOCAST_DTYPES, f'Precision must be one of {", ".join(AUTOCAST_DTYPES)}.'
+    assert precision != 'float16' or device.type == 'cuda', 'Precision "float16" requires a CUDA device.'
+    dtype = AUTOCAST_DTYPES[precision]
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=dtype is not None)
+
+
+def measure_throughput(step: Callable[[torch.Tensor, torch.Tensor], None],
+                       dataset: Union[TorchDataLoader, FastaiDataLoader], device: Union[str, torch.device],
+                       steps: int = 20, warmup: int = 3) -> float:
+    """
+    Measure how many samples per second a step function processes. The data loader is iterated
+    repeatedly if it has fewer than `warmup + steps` batches.
+
+    :param step: Function called with the inputs and targets of each batch (already on `device`).
+    :param dataset: DataLoader to take the batches from.
+    :param device: The device the step function runs on.
+    :param steps: Number of timed steps.
+    :param warmup: Number of untimed steps before the measurement.
+    :return: Samples per second.
+    """
+    device = torch.device(device)
+    
+    def batches():
+        while True:
+            yield from dataset
+    
+    samples = 0
+    start = None
+    for i, (inputs, targets) in enumerate(batches()):
+        if i == warmup:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        if i == warmup + steps:
+            break
+        step(inputs.to(device), targets.to(device))
+        if i >= warmup:
+            samples += len(inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return samples / (time.perf_counter() - start)
+
+
+def available_cpus() -> int:
+    """
+    Determine the number of CPUs this process may use, respecting its CPU affinity as well as the
+    CPU quota of its cgroup (e.g., when running in a container or a batch job).
+
+    :return: The number of usable CPUs.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()
+        if limit != 'max':
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: a quota of -1 means no limit
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, max(1, int(np.ceil(quota))))
+    return cpus
+
+
+def set_threads(num_threads: int, num_interop_threads: int = None) -> None:
+    """
+    Set the number of threads PyTorch uses on the CPU.
+
+    :param num_threads: Number of threads used to parallelize a single operation (intra-op).
+    :param num_interop_threads: Number of threads used to run independent operations in parallel
+        (inter-op). PyTorch only allows setting this once, before any such work has started, so a
+        warning is issued if it is too late.
+    """
+    assert num_threads >= 1, 'Number of threads must be >= 1.'
+    torch.set_num_threads(num_threads)
+    if num_interop_threads is not None and num_interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as ex:
+            warnings.warn(f"unable to set the number of inter-op threads: {ex}")
+
+
+def autotune_threads(model: nn.Module, dataset: Union[TorchDataLoader, FastaiDataLoader],
+                     loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor] = None,
+                     candidates: Tuple[int, ...] = None, steps: int = 10, warmup: int = 2,
+                     use_cuda_if_available: bool = True) -> Tuple[int, pd.DataFrame]:
+    """
+    Benchmark a few steps of a model for different numbers of intra-op threads and keep the
+    fastest setting. If `loss` is given, training steps are measured (on a copy of the model, so
+    the given model is not modified), otherwise inference steps, e.g., before `evaluate_model`.
+    All random number generators (including the one of `dataset`) are restored afterwards, so
+    tuning does not change the order of batches or random augmentations of a seeded run.
+
+    :param model: The model to benchmark.
+    :param dataset: DataLoader to take the batches from.
+    :param loss: The loss function to use for training steps (optional).
+    :param candidates: The numbers of threads to try. By default, powers of two up to the number
+        of CPUs available to this process (see `available_cpus`) and that number itself.
+    :param steps: Number of timed steps per candidate.
+    :param warmup: Number of untimed steps before each measurement.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :return: The chosen number of threads and the samples per second for each candidate.
+    """
+    device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
+    if candidates is None:
+        max_threads = available_cpus()
+        candidates = sorted({2 ** i for i in range(int(np.log2(max_threads)) + 1)} | {max_threads})
+    candidate = copy.deepcopy(model).to(device)
+    if loss is not None:
+        optimizer = torch.optim.SGD([p for p in candidate.parameters() if p.requires_grad], lr=1e-3)
+        candidate.train(True)
+        
+        def step(inputs, targets):
+            error = loss(candidate(inputs).squeeze(dim=1), targets)
+            error.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+    else:
+        candidate.train(False)
+        
+        def step(inputs, targets):
+            with torch.no_grad():
+                candidate(inputs)
+    
+    results = {}
+    rng_states = get_rng_states(dataset)
+    try:
+        for num_threads in candidates:
+            set_threads(num_threads)
+            results[num_threads] = measure_throughput(step, dataset, device, steps=steps, warmup=warmup)
+    finally:
+        set_rng_states(rng_states, dataset)
+    best = max(results, key=results.get)
+    set_threads(best)
+    results = pd.DataFrame({'samples/s': results})
+    results.index.name = 'threads'
+    return best, results
+
+
+class InferenceServer:
+    """
+    Local HTTP server for classifying single images with a trained model. Concurrent requests are
+    collected into batches of up to `max_batch_size` images, waiting at most `max_latency` seconds
+    after the first request of a batch, so that the model can process them in one forward pass.
+
+    Send an encoded image (e.g., the contents of a JPEG or PNG file) as the body of a POST request
+    to `server.url`. The response is a JSON object with the predicted "class", its "label" (if the
+    class names are known) and the class "probabilities".
+
+    Use as a context manager, or call `start` and `stop` explicitly. A stopped server cannot be
+    started again. The server works on a copy of the model, so the given model stays on its device.
+    """
+    
+    def __init__(self, model: Union[nn.Module, Learner], size: int = 224, max_batch_size: int = 16,
+                 max_latency: float = 0.005, num_threads: int = None, port: int = 0, warmup: int = 3,
+                 use_cuda_if_available: bool = False):
+        """
+        :param model: A classification model (see `create_cnn`) or fastai Learner (see `perform_magic`).
+        :param size: The size to resize the images to (as in `load_image_dataset`).
+        :param max_batch_size: Maximum number of images per batch.
+        :param max_latency: Maximum time in seconds a request waits for further requests to batch with.
+        :param num_threads: Number of threads for the forward pass on the CPU (default: all usable CPUs).
+        :param port: Port to listen on at localhost (0 picks a free port, see `url`).
+        :param warmup: Number of forward passes with a full batch before the server accepts requests.
+        :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+        """
+        assert max_batch_size >= 1, 'Maximum batch size must be >= 1.'
+        self.labels = None
+        if isinstance(model, Learner):
+            self.labels = [str(label) for label in model.dls.vocab]
+            model = model.model
+        self.device = torch.device('cuda:0' if use_cuda_if_available and torch.cuda.is_available() else 'cpu')
+        self.model = copy.deepcopy(model).to(self.device)
+        self.model.train(False)
+        self.size = size
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.num_threads = num_threads or available_cpus()
+        self.warmup = warmup
+        self.batch_sizes = []
+        self._requests = queue.Queue()
+        self._stop = threading.Event()
+        self._batcher = None
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._serve_thread = None
+        self._closed = False
+    
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%d/' % self._httpd.server_address[1]
+    
+    def preprocess(self, data: bytes) -> torch.Tensor:
+        # same as the validation transforms of `load_image_dataset`: squish resize and normalize
+        image = PIL.Image.open(io.BytesIO(data)).convert('RGB').resize((self.size, self.size))
+        inputs = torch.from_numpy(np.array(image)).permute(2, 0, 1).float() / 255
+        mean, std = (torch.tensor(stats).view(3, 1, 1) for stats in imagenet_stats)
+        return (inputs - mean) / std
+    
+    def predict(self, data: bytes) -> Dict:
+        """
+        Classify one encoded image, batched with concurrent calls (also used by the HTTP handler).
+        """
+        assert self._batcher is not None, 'The server is not running (call start first).'
+        request = {'inputs': self.preprocess(data), 'arrival': time.perf_counter(), 'done': threading.Event()}
+        self._requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        probabilities = request['output']
+        result = {'class': int(probabilities.argmax()), 'probabilities': probabilities.tolist()}
+        if self.labels is not None:
+            result['label'] = self.labels[result['class']]
+        return result
+    
+    def _handler_class(self):
+        server = self
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    result = server.predict(self.rfile.read(int(self.headers['Content-Length'])))
+                    status, body = 200, json.dumps(result).encode()
+                except Exception as ex:
+                    status, body = 500, json.dumps({'error': str(ex)}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        return Handler
+    
+    def _run_batches(self):
+        torch.set_num_threads(self.num_threads)
+        while not self._stop.is_set():
+            try:
+                batch = [self._requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            # collect further requests until the batch is full or the first request's deadline
+            deadline = batch[0]['arrival'] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with torch.inference_mode():
+                    inputs = torch.stack([request['inputs'] for request in batch]).to(self.device)
+                    outputs = self.model(inputs).softmax(-1).cpu()
+                for request, output in zip(batch, outputs):
+                    request['output'] = output
+            except Exception as ex:
+                for request in batch:
+                    request['error'] = ex
+            self.batch_sizes.append(len(batch))
+            for request in batch:
+                request['done'].set()
+    
+    def start(self) -> 'InferenceServer':
+        assert not self._closed, 'A stopped server cannot be started again (create a new InferenceServer).'
+        assert self._batcher is None, 'The server is already running.'
+        set_threads(self.num_threads)
+        # warm up with full batches, so the first requests do not pay for lazy initialization
+        with torch.inference_mode():
+            inputs = torch.zeros(self.max_batch_size, 3, self.size, self.size, device=self.device)
+            for _ in range(self.warmup):
+                self.model(inputs)
+        self._stop.clear()
+        self._batcher = threading.Thread(target=self._run_batches, daemon=True)
+        self._batcher.start()
+        self._serve_thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._serve_thread.start()
+        return self
+    
+    def stop(self) -> None:
+        # may be called before `start` and more than once (shutdown would block if not serving)
+        if self._serve_thread is not None:
+            self._httpd.shutdown()
+            self._serve_thread.join()
+            self._serve_thread = None
+        self._httpd.server_close()
+        self._closed = True
+        self._stop.set()
+        if self._batcher is not None:
+            self._batcher.join()
+            self._batcher = None
+    
+    def __enter__(self) -> 'InferenceServer':
+        return self.start()
+    
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def benchmark_inference_server(model: Union[nn.Module, Learner], image: Union[str, Path, bytes],
+                               batch_sizes: Tuple[int, ...] = (1, 4, 8, 16, 32), num_clients: int = 32,
+                               requests_per_client: int = 20, max_latency: float = 0.005,
+                               **kwargs) -> pd.DataFrame:
+    """
+    Measure the latency and throughput of an `InferenceServer` under load for different maximum
+    batch sizes, with `num_clients` threads each sending requests one after another.
+
+    :param model: The model to serve.
+    :param image: An image file (or its contents) to send with each request.
+    :param batch_sizes: The maximum batch sizes to compare.
+    :param num_clients: Number of concurrent clients.
+    :param requests_per_client: Number of requests each client sends.
+    :param max_latency: Maximum time in seconds a request waits for further requests to batch with.
+    :param kwargs: Further arguments for `InferenceServer`.
+    :return: Latency percentiles, throughput and average batch size (columns) per maximum batch
+        size (rows).
+    """
+    data = image if isinstance(image, bytes) else Path(image).read_bytes()
+    results = {}
+    for batch_size in batch_sizes:
+        with InferenceServer(model, max_batch_size=batch_size, max_latency=max_latency, **kwargs) as server:
+            latencies = []
+            
+            def client():
+                for _ in range(requests_per_client):
+                    start = time.perf_counter()
+                    with urllib.request.urlopen(urllib.request.Request(server.url, data=data), timeout=60) as response:
+                        response.read()
+                    latencies.append(time.perf_counter() - start)
+            
+            clients = [threading.Thread(target=client) for _ in range(num_clients)]
+            start = time.perf_counter()
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            seconds = time.perf_counter() - start
+            results[batch_size] = {'p50 latency ms': np.percentile(latencies, 50) * 1000,
+                                   'p99 latency ms': np.percentile(latencies, 99) * 1000,
+                                   'requests/s': len(latencies) / seconds,
+                                   'mean batch size': np.mean(server.batch_sizes)}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results.index.name = 'max batch size'
+    return results
+
+
+class MetricAccumulator:
+    """
+    Streaming accumulator for the (weighted) mean of scalar tensors. The running sum is kept
+    on the device of the accumulated values and only transferred to the host in `compute`,
+    avoiding a device synchronization for every update.
+    """
+    
+    def __init__(self, device: Union[str, torch.device] = 'cpu'):
+        self.device = torch.device(device)
+        self.reset()
+    
+    def reset(self) -> None:
+        """
+        Discard all accumulated values.
+        """
+        self.total = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.weight = 0
+    
+    def update(self, value: torch.Tensor, weight: Union[int, float] = 1) -> None:
+        """
+        Add a (detached) scalar value with the given weight to the running sum.
+        
+        :param value: Scalar tensor to accumulate.
+        :param weight: Weight of the value, e.g., the number of samples it was averaged over.
+        """
+        self.total += value.detach() * weight
+        self.weight += weight
+    
+    def compute(self) -> float:
+        """
+        Compute the weighted mean of all accumulated values (this synchronizes with the device).
+        
+        :return: Weighted mean as a Python float.
+        """
+        return self.total.item() / self.weight if self.weight else float('nan')
+    
+    def all_reduce(self) -> None:
+        """
+        Sum up the accumulated values of all processes if running in a distributed process group.
+        """
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            totals = torch.stack([self.total, torch.tensor(float(self.weight), dtype=torch.float64,
+                                                           device=self.device)])
+            torch.distributed.all_reduce(totals)
+            self.total.copy_(totals[0])
+            self.weight = totals[1].item()
+
+
+class BatchPrefetcher:
+    """
+    Wraps a data loader and prepares its batches in a background thread, so that data loading
+    overlaps with computation. Up to `queue_size` batches are kept ready in a bounded queue,
+    already moved to the target device. The time the consumer spent waiting for the next batch
+    is accumulated in `wait_time` (reset whenever a new iteration is started).
+    """
+    
+    _END = object()
+    
+    def __init__(self, loader: Union[TorchDataLoader, FastaiDataLoader], device: Union[str, torch.device],
+                 queue_size: int = 2, pin_memory: bool = False):
+        assert queue_size >= 1, 'Queue size must be >= 1.'
+        self.loader = loader
+        self.device = torch.device(device)
+        self.queue_size = queue_size
+        # pinned memory only speeds up host-to-GPU copies
+        self.pin_memory = pin_memory and self.device.type == 'cuda'
+        self.wait_time = 0.0
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    @property
+    def dataset(self):
+        return self.loader.dataset
+    
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        if self.pin_memory and not tensor.is_cuda:
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=self.pin_memory)
+    
+    def __iter__(self):
+        self.wait_time = 0.0
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+        
+        def put(item):
+            # do not block forever if the consumer stopped iterating early
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(tuple(self._to_device(t) for t in batch)):
+                        return
+            except Exception as ex:
+                errors.append(ex)
+            put(self._END)
+        
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if batch is self._END:
+                    break
+                yield batch
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            thread.join()
+
+
+class StepProfiler:
+    """
+    Low-overhead profiler for the phases of a training step. Phases are delimited by calls to
+    `mark`, and the wall-clock time spent in each phase is summed up per epoch. On CUDA devices,
+    every mark synchronizes with the device so that asynchronous kernels are attributed to the
+    correct phase. Optionally, a Chrome trace of `trace_steps` steps (after one warm-up step) is
+    recorded with `torch.profiler` and written to `trace_file`.
+    """
+    
+    PHASES = ('data', 'transfer', 'forward', 'loss', 'backward', 'optimizer')
+    
+    def __init__(self, device: Union[str, torch.device], enabled: bool = True, trace_file: Union[str, Path] = None,
+                 trace_steps: int = 10):
+        device = torch.device(device)
+        self.enabled = enabled
+        self.synchronize = enabled and device.type == 'cuda'
+        self.epochs = []
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.last = None
+        self.range = None
+        self.trace = None
+        if enabled and trace_file is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=0, warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=lambda prof: prof.export_chrome_trace(str(trace_file)))
+            self.trace.start()
+    
+    def _enter(self, phase: Union[str, None]) -> None:
+        # label the upcoming phase in the Chrome trace
+        if self.trace is None:
+            return
+        if self.range is not None:
+            self.range.__exit__(None, None, None)
+        self.range = torch.profiler.record_function(phase) if phase is not None else None
+        if self.range is not None:
+            self.range.__enter__()
+    
+    def start(self) -> None:
+        """
+        Mark the beginning of a training step (the first phase is waiting for data).
+        """
+        if not self.enabled:
+            return
+        self._enter(self.PHASES[0])
+        self.last = time.perf_counter()
+    
+    def mark(self, phase: str, following: str = None) -> None:
+        """
+        Mark the end of the given phase, which also starts the next one.
+        
+        :param phase: One of `PHASES`.
+        :param following: The phase that starts now, if it is not the next one in `PHASES`
+            (e.g., another forward pass when processing micro-batches).
+        """
+        if not self.enabled:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times[phase] += now - self.last
+        self.last = now
+        index = self.PHASES.index(phase) + 1
+        if following is None and index < len(self.PHASES):
+            following = self.PHASES[index]
+        self._enter(following)
+        if self.trace is not None and index == len(self.PHASES):
+            self.trace.step()
+    
+    def end_epoch(self) -> None:
+        """
+        Store the phase times of the current epoch and start over.
+        """
+        if not self.enabled:
+            return
+        self._enter(None)
+        self.epochs.append(self.times)
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+    
+    def close(self) -> None:
+        """
+        Stop recording and write the Chrome trace (if requested).
+        """
+        if self.trace is not None:
+            self._enter(None)
+            self.trace.stop()
+            self.trace = None
+    
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: Seconds spent in each phase (columns) per epoch (rows).
+        """
+        return pd.DataFrame(self.epochs, index=np.arange(1, len(self.epochs) + 1), columns=list(self.PHASES))
+
+
+class AsyncCheckpointer:
+    """
+    Writes training checkpoints to a directory in a background thread. All tensors are copied to
+    host memory before `save` returns, so training can continue while the copy is written to disk.
+    Each file is first written under a temporary name and then atomically renamed, so an
+    interrupted write never leaves a corrupt checkpoint behind. Only the `keep` most recent
+    checkpoints are kept. The duration and size of every write are recorded in `stats`.
+    """
+    
+    def __init__(self, directory: Union[str, Path], keep: int = 2):
+        assert keep >= 1, 'At least one checkpoint must be kept.'
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.keep = keep
+        self.stats = []
+        self.thread = None
+        self.error = None
+    
+    @staticmethod
+    def _snapshot(obj):
+        # recursively copy all tensors to host memory
+        if isinstance(obj, torch.Tensor):
+            return obj.detach().to('cpu', copy=True)
+        if isinstance(obj, dict):
+            return {key: AsyncCheckpointer._snapshot(value) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(AsyncCheckpointer._snapshot(value) for value in obj)
+        return copy.deepcopy(obj)
+    
+    def save(self, state: Dict, step: int) -> None:
+        """
+        Snapshot the given state and write it to "checkpoint_<step>.pt" in the background.
+        Waits for the previous write to finish first, so at most one write is in flight.
+        
+        :param state: The state to store (nested dicts, lists and tuples of tensors and Python objects).
+        :param step: Number of the training step, used to name the file.
+        """
+        start = time.perf_counter()
+        state = self._snapshot(state)
+        snapshot_time = time.perf_counter() - start
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state, step, snapshot_time), daemon=True)
+        self.thread.start()
+    
+    def _write(self, state: Dict, step: int, snapshot_time: float) -> None:
+        path = self.directory / f'checkpoint_{step:08d}.pt'
+        temp_path = path.with_suffix('.pt.tmp')
+        start = time.perf_counter()
+        try:
+            torch.save(state, temp_path)
+            os.replace(temp_path, path)
+            for old in sorted(self.directory.glob('checkpoint_*.pt'))[:-self.keep]:
+                old.unlink()
+        except Exception as ex:
+            self.error = ex
+            return
+        self.stats.append({'file': path.name, 'snapshot seconds': snapshot_time,
+                           'write seconds': time.perf_counter() - start, 'megabytes': path.stat().st_size / 2 ** 20})
+    
+    def wait(self) -> None:
+        """
+        Wait for the pending write (if any) to finish and raise its error (if any).
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+    
+    @staticmethod
+    def load(path: Union[str, Path], device: Union[str, torch.device] = 'cpu') -> Dict:
+        """
+        Load a checkpoint.
+        
+        :param path: A checkpoint file, or a directory to load the most recent checkpoint from.
+        :param device: The device to move all tensors to.
+        :return: The stored state.
+        """
+        path = Path(path)
+        if path.is_dir():
+            checkpoints = sorted(path.glob('checkpoint_*.pt'))
+            assert checkpoints, f'No checkpoints found in {path}.'
+            path = checkpoints[-1]
+        return torch.load(path, map_location=device)
+
+
+# optimizers that can be selected by name in `create_optimizer`
+OPTIMIZERS = {'sgd': torch.optim.SGD, 'adam': torch.optim.Adam, 'adamw': torch.optim.AdamW,
+              'rmsprop': torch.optim.RMSprop}
+
+
+def create_optimizer(model: nn.Module, optimizer: Union[str, type] = 'sgd',
+                     learning_rate: Union[float, int] = 0.01, momentum: Union[float, int] = 0,
+                     weight_decay: float = 0, decay_norm_and_bias: bool = False,
+                     implementation: str = 'foreach') -> torch.optim.Optimizer:
+    """
+    Create an optimizer for the parameters of a model.
+
+    :param model: The model to optimize the parameters of.
+    :param optimizer: Name of the optimizer ("sgd", "adam", "adamw" or "rmsprop") or a
+        torch.optim.Optimizer class.
+    :param learning_rate: Learning rate for the update steps.
+    :param momentum: Momentum term for the update steps (only used by optimizers that have one,
+        e.g., SGD and RMSprop).
+    :param weight_decay: Weight decay (L2 penalty, or decoupled weight decay for AdamW).
+    :param decay_norm_and_bias: Whether to apply weight decay to biases and normalization layers
+        (all parameters with less than two dimensions), which is usually not beneficial.
+    :param implementation: "foreach" to update all parameters with a few multi-tensor operations,
+        "fused" for a single fused kernel (only supported by some optimizers and devices) or
+        "for-loop" to update one parameter after another.
+    :return: The optimizer.
+    """
+    assert implementation in ('for-loop', 'foreach', 'fused'), \
+        'Implementation must be "for-loop", "foreach" or "fused".'
+    cls = OPTIMIZERS[optimizer.lower()] if isinstance(optimizer, str) else optimizer
+    accepted = inspect.signature(cls).parameters
+    params = list(model.parameters())
+    if weight_decay and not decay_norm_and_bias:
+        params = [{'params': [p for p in params if p.dim() > 1]},
+                  {'params': [p for p in params if p.dim() <= 1], 'weight_decay': 0}]
+    kwargs = {'lr': learning_rate}
+    if weight_decay:
+        kwargs['weight_decay'] = weight_decay
+    if 'momentum' in accepted:
+        kwargs['momentum'] = momentum
+    if implementation == 'for-loop':
+        if 'foreach' in accepted:
+            kwargs['foreach'] = False
+    elif implementation in accepted:
+        kwargs[implementation] = True
+    elif implementation == 'fused':
+        raise ValueError(f'{cls.__name__} has no fused implementation.')
+    return cls(params, **kwargs)
+
+
 def run_gradient_descent(model: torch.nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
                          training_set: Union[TorchDataLoader, FastaiDataLoader], iterations: int,
                          learning_rate: Union[float, int], momentum: Union[float, int],
                          valid_set: Union[TorchDataLoader, FastaiDataLoader] = None, lr_schedule: str = None,
                          plot_curves: bool = False, use_cuda_if_available: bool = True,
-                         show_batch_progress: bool = False) -> pd.DataFrame:
+                         show_batch_progress: bool = False, log_every: int = None, prefetch: int = 0,
+                         pin_memory: bool = False, profile: bool = False,
+                         trace_file: Union[str, Path] = None,
+                         precision: str = 'float32', accumulate_batches: int = 1,
+                         micro_batch_size: int = None, checkpoint_dir: Union[str, Path] = None,
+                         checkpoint_every: int = None, resume_from: Union[str, Path] = None,
+                         compile: str = None, threads: Union[int, str] = None,
+                         optimizer: Union[str, type] = 'sgd', weight_decay: float = 0
+                         ) -> Union[pd.DataFrame, Tuple[pd.DataFrame, ...]]:
     """
     Minimize the loss of a model on a dataset.
 
@@ -453,23 +1768,78 @@ def run_gradient_descent(model: torch.nn.Module, loss: Callable[[torch.Tensor, t
     :param plot_curves: If True, plot loss and learning rate curves when finished.
     :param show_batch_progress: If True, the progress bar will show the number of batches. If
         False, the progress par will show the number of individual samples.
-    :return: Loss per epoch.
+    :param log_every: If given, the running training loss is materialized every `log_every` batches
+        and shown in the progress bar. Otherwise, it is only read back at the end of each epoch.
+    :param prefetch: If > 0, training batches are loaded and moved to the device in a background
+        thread, keeping up to `prefetch` batches ready. The time spent waiting for data is reported
+        after each epoch.
+    :param pin_memory: Whether to copy prefetched batches via pinned memory (only relevant for CUDA).
+    :param profile: If True, time the phases of each training step (data wait, host-to-device copy,
+        forward, loss, backward and optimizer step) and additionally return them per epoch.
+    :param trace_file: If given (requires `profile`), a Chrome trace of a few training steps is
+        recorded with `torch.profiler` and written to this file.
+    :param precision: Precision for the forward pass and loss computation: "float32", "bfloat16"
+        or "float16" (CUDA only, with loss scaling). See `precision_context`.
+    :param accumulate_batches: Accumulate the gradients of this many batches before each update
+        step, which behaves like training with a correspondingly larger batch size. Learning rate
+        schedules count update steps, not batches.
+    :param micro_batch_size: If given, each batch is split into micro-batches of at most this size
+        whose gradients are accumulated, reducing the memory needed for activations. Note that
+        batch normalization then only sees the micro-batches.
+    :param checkpoint_dir: If given, checkpoints of the model, optimizer, scheduler, random number
+        generators and data position are written to this directory in the background.
+    :param checkpoint_every: Write a checkpoint every this many update steps. If None, a
+        checkpoint is written at the end of each epoch.
+    :param resume_from: Checkpoint file (or directory with checkpoints) to continue training from,
+        including from the middle of an epoch. The model, optimizer and data loaders must be set
+        up as in the original run. Resuming reproduces the original run exactly unless batches
+        are prefetched (`prefetch`) or loaded in worker processes.
+    :param compile: If given, the forward passes use a compiled version of the model (see
+        `compile_model`), which shares its parameters with the model.
+    :param threads: Number of intra-op threads to use on the CPU, or "auto" to pick the fastest
+        setting with a short benchmark (see `autotune_threads`). By default, PyTorch's setting
+        is kept.
+    :param optimizer: The optimizer to use (see `create_optimizer`), by default SGD. All
+        optimizers use their multi-tensor ("foreach") implementation.
+    :param weight_decay: Weight decay, not applied to biases and normalization layers.
+    :return: Loss per epoch. If `profile` is True, a tuple of the loss per epoch and the seconds
+        spent in each phase per epoch.
     """
     assert isinstance(training_set, (TorchDataLoader, FastaiDataLoader)),\
         f'Invalid dataset (must be PyTorch DataLoader or fastai DataLoader, not {type(training_set)}).'
     assert iterations >= 0, 'Iterations must be non-negative.'
     assert (type(learning_rate) in (int, float)) and learning_rate > 0, 'Learning-rate must be > 0.'
     assert (type(momentum) in (int, float)) and momentum >= 0, 'Momentum must be non-negative.'
+    assert log_every is None or log_every >= 1, 'Logging interval must be >= 1.'
+    assert prefetch >= 0, 'Number of prefetched batches must be non-negative.'
+    assert trace_file is None or profile, 'Recording a trace requires profile=True.'
+    assert precision in AUTOCAST_DTYPES, f'Precision must be one of {", ".join(AUTOCAST_DTYPES)}.'
+    assert accumulate_batches >= 1, 'Number of accumulated batches must be >= 1.'
+    assert micro_batch_size is None or micro_batch_size >= 1, 'Micro-batch size must be >= 1.'
+    assert checkpoint_every is None or checkpoint_every >= 1, 'Checkpoint interval must be >= 1.'
+    assert checkpoint_every is None or checkpoint_dir is not None, 'Checkpoint interval requires checkpoint_dir.'
     device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
 
     # move model to GPU if available (we already set the device accordingly)
     model = model.to(device)
+    net = compile_model(model, compile) if compile is not None else model
+
+    # choose the number of CPU threads
+    if threads == "auto":
+        threads, _ = autotune_threads(model, training_set, loss=loss, use_cuda_if_available=use_cuda_if_available)
+        print(f'Using {threads} threads')
+    elif threads is not None:
+        set_threads(threads)
 
     # instantiate optimizer
-    optimizer = torch.optim.SGD(params=model.parameters(), lr=learning_rate, momentum=momentum)
+    optimizer = create_optimizer(model, optimizer, learning_rate, momentum, weight_decay)
 
-    # instantiate scheduler
-    total_steps = iterations * len(training_set)
+    # loss scaling is only needed for float16 (bfloat16 has the same exponent range as float32)
+    scaler = getattr(torch.amp, 'GradScaler', torch.cuda.amp.GradScaler)(enabled=precision == 'float16')
+
+    # instantiate scheduler (which counts update steps, not batches)
+    steps_per_epoch = int(np.ceil(len(training_set) / accumulate_batches))
+    total_steps = iterations * steps_per_epoch
     if lr_schedule == "linear":
         scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1 - step / total_steps)
         schedule_at = "batch"
@@ -477,44 +1847,157 @@ def run_gradient_descent(model: torch.nn.Module, loss: Callable[[torch.Tensor, t
         scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer)
         schedule_at = "epoch"
     elif lr_schedule == "onecycle":
-        scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=learning_rate, total_steps=total_steps)
+        # momentum is cycled as well for optimizers that have one (or Adam's first beta)
+        cycle_momentum = 'momentum' in optimizer.defaults or 'betas' in optimizer.defaults
+        scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=learning_rate, total_steps=total_steps,
+                                                        cycle_momentum=cycle_momentum)
         schedule_at = "batch"
     else:
         schedule_at = "never"
     
     # run training loop
     batch_size = training_set.batch_size if isinstance(training_set, TorchDataLoader) else training_set.bs
-    pbar = tqdm(total=len(training_set) if show_batch_progress else len(training_set.dataset))
-    assert int(np.ceil(len(training_set.dataset) / batch_size)) == len(training_set)
+    # the sampler determines the samples per epoch (e.g., only a shard in data-parallel training)
+    dataset_size = len(training_set.sampler) if isinstance(training_set, TorchDataLoader) else len(training_set.dataset)
+    assert int(np.ceil(dataset_size / batch_size)) == len(training_set)
+    # in data-parallel training (see `run_data_parallel`), only the first process reports progress
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    world_size = torch.distributed.get_world_size() if distributed else 1
+    verbose = not distributed or torch.distributed.get_rank() == 0
+    pbar = tqdm(total=len(training_set) if show_batch_progress else dataset_size, disable=not verbose)
+    batches = BatchPrefetcher(training_set, device, queue_size=prefetch, pin_memory=pin_memory)\
+        if prefetch else training_set
     errors = []
     valid_errors = []
+    # training losses are accumulated on the device and only read back when needed
+    train_loss = MetricAccumulator(device)
     learning_rates = []
-    for epoch in range(iterations):
+    profiler = StepProfiler(device, enabled=profile, trace_file=trace_file)
+    checkpointer = AsyncCheckpointer(checkpoint_dir) if checkpoint_dir is not None and verbose else None
+    updates = 0
+    
+    def training_state(epoch, batch_index, epoch_rng_states):
+        # everything needed to continue training after the given batch of the given epoch
+        return {'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                # some schedulers store (unpicklable) functions, which are recreated anyway
+                'scheduler': {key: value for key, value in scheduler.state_dict().items() if not callable(value)}
+                if schedule_at != "never" else None,
+                'scaler': scaler.state_dict(),
+                'epoch': epoch, 'batch': batch_index, 'updates': updates,
+                'epoch_rng_states': epoch_rng_states, 'rng_states': get_rng_states(training_set),
+                'errors': errors, 'valid_errors': valid_errors, 'learning_rates': learning_rates,
+                'train_loss': (train_loss.total, train_loss.weight), 'num_samples': num_samples}
+    
+    # restore a previous training state if requested
+    resume_state = None
+    start_epoch = 0
+    if resume_from is not None:
+        resume_state = AsyncCheckpointer.load(resume_from)
+        model.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        if schedule_at != "never":
+            scheduler.load_state_dict(resume_state['scheduler'])
+        scaler.load_state_dict(resume_state['scaler'])
+        errors = resume_state['errors']
+        valid_errors = resume_state['valid_errors']
+        learning_rates = resume_state['learning_rates']
+        updates = resume_state['updates']
+        start_epoch = resume_state['epoch']
+    
+    for epoch in range(start_epoch, iterations):
         pbar.set_description(f'Epoch {epoch + 1}/{iterations}')
         pbar.reset()
-        errors.append(0)
-        model.train(True)
-        for inputs, targets in training_set:
+        train_loss.reset()
+        net.train(True)
+        num_samples = 0
+        first_batch = 0
+        if hasattr(getattr(training_set, 'sampler', None), 'set_epoch'):
+            # distributed samplers shuffle differently in each epoch only if told so
+            training_set.sampler.set_epoch(epoch)
+        # the data order of an epoch is determined by the random state when the iteration starts
+        if resume_state is not None:
+            set_rng_states(resume_state['epoch_rng_states'] or resume_state['rng_states'], training_set)
+        epoch_rng_states = get_rng_states(training_set)
+        data = iter(batches)
+        if resume_state is not None:
+            first_batch = resume_state['batch']
+            if first_batch:
+                # skip the batches that were already processed, then continue with the stored random state
+                for _ in range(first_batch):
+                    next(data)
+                set_rng_states(resume_state['rng_states'], training_set)
+                train_loss.total.copy_(resume_state['train_loss'][0])
+                train_loss.weight = resume_state['train_loss'][1]
+                num_samples = resume_state['num_samples']
+                pbar.update(first_batch if show_batch_progress else num_samples)
+            resume_state = None
+        start = time.perf_counter()
+        profiler.start()
+        for batch_index, (inputs, targets) in enumerate(data, start=first_batch):
+            profiler.mark('data')
             inputs = inputs.to(device)
             targets = targets.to(device)
-            preds = model(inputs)
-            error = loss(preds.squeeze(dim=1), targets)
-            errors[-1] += error.item()
-            error.backward()
-            optimizer.step()
-            optimizer.zero_grad()
+            profiler.mark('transfer')
+            # number of batches whose gradients are accumulated for the current update step
+            # (the last group of an epoch may be smaller)
+            group_start = batch_index - batch_index % accumulate_batches
+            group_size = min(accumulate_batches, len(training_set) - group_start)
+            # split into micro-batches and weight their losses to get the mean over the group
+            input_chunks = inputs.split(micro_batch_size or len(inputs))
+            target_chunks = targets.split(micro_batch_size or len(inputs))
+            batch_error = 0
+            for chunk_index, (chunk_inputs, chunk_targets) in enumerate(zip(input_chunks, target_chunks)):
+                with precision_context(device, precision):
+                    preds = net(chunk_inputs)
+                    profiler.mark('forward')
+                    error = loss(preds.squeeze(dim=1), chunk_targets)
+                weight = len(chunk_inputs) / len(inputs)
+                batch_error = batch_error + error.detach() * weight
+                profiler.mark('loss')
+                scaler.scale(error * (weight / group_size)).backward()
+                profiler.mark('backward', following='forward' if chunk_index + 1 < len(input_chunks) else None)
+            train_loss.update(batch_error)
+            num_samples += len(inputs)
+            if batch_index + 1 == group_start + group_size:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+                learning_rates.append(optimizer.param_groups[0]['lr'])
+                if schedule_at == "batch":
+                    scheduler.step()
+                updates += 1
+                if checkpointer is not None and checkpoint_every and updates % checkpoint_every == 0:
+                    checkpointer.save(training_state(epoch, batch_index + 1, epoch_rng_states), updates)
+            profiler.mark('optimizer')
             pbar.update(1 if show_batch_progress else len(inputs))
-            learning_rates.append(optimizer.param_groups[0]['lr'])
-            if schedule_at == "batch":
-                scheduler.step()
-        errors[-1] /= len(training_set)
+            if log_every and train_loss.weight % log_every == 0:
+                pbar.set_postfix(loss=f'{train_loss.compute():.6f}')
+            profiler.start()
+        profiler.end_epoch()
+        train_loss.all_reduce()
+        errors.append(train_loss.compute())
+        throughput = world_size * num_samples / (time.perf_counter() - start)
         if valid_set is not None:
-            valid_errors.append(evaluate_model(model, valid_set, loss=loss)['loss'])
-        print(f'Epoch {epoch + 1:2d} finished with training loss: {errors[-1]:.6f}' +
-              (f' and validation loss: {valid_errors[-1]:.6f}' if valid_set else ''))
+            valid_errors.append(evaluate_model(net, valid_set, precision=precision, loss=loss)['loss'])
+        if verbose:
+            print(f'Epoch {epoch + 1:2d} finished with training loss: {errors[-1]:.6f}' +
+                  (f' and validation loss: {valid_errors[-1]:.6f}' if valid_set else '') +
+                  f' ({throughput:.1f} samples/s in {precision}' +
+                  (f', waited {batches.wait_time:.2f}s for data)' if prefetch else ')'))
         if schedule_at == "epoch":
             scheduler.step(errors[-1] if valid_set is None else valid_errors[-1])
+        if checkpointer is not None:
+            if not checkpoint_every:
+                checkpointer.save(training_state(epoch + 1, 0, None), updates)
+            if checkpointer.stats:
+                stats = checkpointer.stats[-1]
+                print(f'Checkpoint {stats["file"]}: {stats["megabytes"]:.1f} MB, copied in '
+                      f'{stats["snapshot seconds"]:.2f}s and written in {stats["write seconds"]:.2f}s')
     pbar.close()
+    profiler.close()
+    if checkpointer is not None:
+        checkpointer.wait()
     
     # compile training curves
     curves = {'training loss': np.asarray(errors)}
@@ -527,35 +2010,897 @@ def run_gradient_descent(model: torch.nn.Module, loss: Callable[[torch.Tensor, t
         sns.lineplot(data=curves)
         plt.show()
     
+    if profile:
+        return curves, profiler.to_frame()
     return curves
 
 
-def evaluate_model(model: torch.nn.Module, dataset: Union[TorchDataLoader, FastaiDataLoader],
+def find_learning_rate(model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                       training_set: Union[TorchDataLoader, FastaiDataLoader], min_lr: float = 1e-7,
+                       max_lr: float = 10, num_steps: int = 200, momentum: Union[float, int] = 0.9,
+                       smoothing: float = 0.98, divergence_factor: float = 4, precision: str = 'float32',
+                       plot_curves: bool = True, use_cuda_if_available: bool = True) -> Tuple[float, pd.DataFrame]:
+    """
+    Learning rate range test: train a model for up to `num_steps` batches while increasing the
+    learning rate exponentially from `min_lr` to `max_lr`, and record the (smoothed) training loss.
+    The test stops early once the loss diverges, and the original parameters (and training mode)
+    of the model are restored afterwards. The suggested learning rate is a tenth of the learning rate with the
+    lowest smoothed loss, a good `learning_rate` for `run_gradient_descent` with the "onecycle"
+    schedule (which uses it as the peak learning rate).
+
+    :param model: The model to test (its parameters are restored afterwards).
+    :param loss: The loss function to minimize.
+    :param training_set: DataLoader for the training data (iterated repeatedly if too short).
+    :param min_lr: Learning rate of the first step.
+    :param max_lr: Learning rate of the last step.
+    :param num_steps: Number of training steps.
+    :param momentum: Momentum term for the update steps.
+    :param smoothing: Factor of the exponential moving average of the loss.
+    :param divergence_factor: Stop once the smoothed loss exceeds this multiple of its minimum.
+    :param precision: Precision for the forward pass and loss computation (see `precision_context`).
+    :param plot_curves: If True, plot the loss against the learning rate.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :return: The suggested learning rate, and the learning rate, loss and smoothed loss per step.
+    """
+    assert 0 < min_lr < max_lr, 'Learning rates must satisfy 0 < min_lr < max_lr.'
+    assert num_steps >= 2, 'Number of steps must be >= 2.'
+    assert 0 <= smoothing < 1, 'Smoothing must be in [0, 1).'
+    device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
+    model = model.to(device)
+    state = copy.deepcopy(model.state_dict())
+    training = model.training
+    
+    # exponential schedule from min_lr (step 0) to max_lr (last step)
+    optimizer = torch.optim.SGD(params=model.parameters(), lr=min_lr, momentum=momentum)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lambda step: (max_lr / min_lr) ** (step / (num_steps - 1)))
+    
+    def batches():
+        while True:
+            yield from training_set
+    
+    records = []
+    average = 0
+    best = np.inf
+    model.train(True)
+    try:
+        for step, (inputs, targets) in enumerate(tqdm(batches(), total=num_steps, desc='Finding learning rate')):
+            if step == num_steps:
+                break
+            learning_rate = optimizer.param_groups[0]['lr']
+            inputs = inputs.to(device)
+            targets = targets.to(device)
+            with precision_context(device, precision):
+                error = loss(model(inputs).squeeze(dim=1), targets)
+            error.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            scheduler.step()
+            # exponential moving average with bias correction (the loss has to be read back anyway)
+            value = error.item()
+            average = smoothing * average + (1 - smoothing) * value
+            smoothed = average / (1 - smoothing ** (step + 1))
+            records.append((learning_rate, value, smoothed))
+            if not np.isfinite(smoothed) or smoothed > divergence_factor * best:
+                break
+            best = min(best, smoothed)
+    finally:
+        model.load_state_dict(state)
+        model.train(training)
+        optimizer.zero_grad()
+    
+    results = pd.DataFrame(records, columns=['learning rate', 'loss', 'smoothed loss'])
+    results.index.name = 'step'
+    suggestion = results['learning rate'][results['smoothed loss'].idxmin()] / 10
+    
+    # plot curves if requested
+    if plot_curves:
+        ax = sns.lineplot(data=results, x='learning rate', y='smoothed loss')
+        ax.set_xscale('log')
+        ax.axvline(suggestion, color='red', linestyle='--', label=f'suggestion: {suggestion:.2e}')
+        ax.legend()
+        plt.show()
+    return suggestion, results
+
+
+def evaluate_model(model: torch.nn.Module, dataset: Union[TorchDataLoader, FastaiDataLoader], *,
+                   precision: str = 'float32', compile: str = None,
                    **losses: Callable[[torch.Tensor, torch.Tensor], torch.Tensor]) -> Dict[str, float]:
     """
     Computes one or more loss functions for a model on a dataset.
 
     :param model: The model to optimize the parameters of.
     :param dataset: DataLoader for the evaluation data.
+    :param precision: Precision for the forward pass and loss computation (see `precision_context`).
+    :param compile: If given, evaluate a compiled version of the model (see `compile_model`).
     :param losses: The loss functions to compute.
     :return: A float for each given loss function.
     """
-    device = next(model.parameters()).device
+    # modules with inlined weights (e.g., from `optimize_for_inference`) run on the CPU
+    device = next(model.parameters(), torch.empty(0)).device
+    if compile is not None:
+        model = compile_model(model, compile)
 
-    results = {name: 0.0 for name in losses}
+    # one accumulator per loss function, all fed from a single forward pass per batch
+    results = {name: MetricAccumulator(device) for name in losses}
     model.train(False)
-    for inputs, targets in dataset:
-        inputs = inputs.to(device)
-        targets = targets.to(device)
-        for name, loss in losses.items():
-            with torch.no_grad():
-                preds = model(inputs)
-                results[name] += loss(preds.squeeze(dim=1), targets).item() * len(inputs)
-    results = {name: loss / len(dataset.dataset)
-               for name, loss in results.items()}
+    with torch.no_grad(), precision_context(device, precision):
+        for inputs, targets in dataset:
+            inputs = inputs.to(device)
+            targets = targets.to(device)
+            preds = model(inputs).squeeze(dim=1)
+            for name, loss in losses.items():
+                results[name].update(loss(preds, targets), weight=len(inputs))
+    return {name: accumulator.compute() for name, accumulator in results.items()}
+
+
+def benchmark_precision(model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                        dataset: Union[TorchDataLoader, FastaiDataLoader],
+                        precisions: Tuple[str, ...] = ('float32', 'bfloat16'), steps: int = 20, warmup: int = 3,
+                        use_cuda_if_available: bool = True) -> pd.DataFrame:
+    """
+    Compare the training and evaluation throughput of a model in different precisions. Each
+    precision is measured on a fresh copy of the model, so the given model is not modified.
+
+    :param model: The model to benchmark.
+    :param loss: The loss function to use for training.
+    :param dataset: DataLoader to take the batches from.
+    :param precisions: The precisions to compare (see `precision_context`).
+    :param steps: Number of timed steps per measurement.
+    :param warmup: Number of untimed steps before each measurement.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :return: Samples per second for training and evaluation (columns) per precision (rows).
+    """
+    device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
+    results = {}
+    for precision in precisions:
+        candidate = copy.deepcopy(model).to(device)
+        optimizer = torch.optim.SGD([p for p in candidate.parameters() if p.requires_grad], lr=1e-3)
+        
+        def train_step(inputs, targets):
+            with precision_context(device, precision):
+                error = loss(candidate(inputs).squeeze(dim=1), targets)
+            error.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        
+        def eval_step(inputs, targets):
+            with torch.no_grad(), precision_context(device, precision):
+                candidate(inputs)
+        
+        candidate.train(True)
+        train = measure_throughput(train_step, dataset, device, steps=steps, warmup=warmup)
+        candidate.train(False)
+        evaluation = measure_throughput(eval_step, dataset, device, steps=steps, warmup=warmup)
+        results[precision] = {'training samples/s': train, 'evaluation samples/s': evaluation}
+    return pd.DataFrame.from_dict(results, orient='index')
+
+
+def benchmark_compile(model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                      dataset: Union[TorchDataLoader, FastaiDataLoader], compile: str = 'inductor', steps: int = 20,
+                      use_cuda_if_available: bool = True) -> pd.DataFrame:
+    """
+    Compare the training speed of a model with and without compilation. The first step includes
+    the compilation (or loading it from the cache), the remaining steps show the steady state.
+    Each variant is measured on a fresh copy of the model, so the given model is not modified.
+
+    :param model: The model to benchmark.
+    :param loss: The loss function to use for training.
+    :param dataset: DataLoader to take the batches from.
+    :param compile: The compilation mode to compare against eager execution (see `compile_model`).
+    :param steps: Number of timed steady-state steps.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :return: Duration of the first step, steady-state samples per second and the number of samples
+        after which compilation has paid off (columns) for eager and compiled execution (rows).
+    """
+    device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
+    results = {}
+    for mode in ('eager', compile):
+        candidate = copy.deepcopy(model).to(device)
+        optimizer = torch.optim.SGD([p for p in candidate.parameters() if p.requires_grad], lr=1e-3)
+        net = compile_model(candidate, mode) if mode != 'eager' else candidate
+        net.train(True)
+        
+        def train_step(inputs, targets):
+            error = loss(net(inputs).squeeze(dim=1), targets)
+            error.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        
+        inputs, targets = next(iter(dataset))
+        start = time.perf_counter()
+        train_step(inputs.to(device), targets.to(device))
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        first_step = time.perf_counter() - start
+        throughput = measure_throughput(train_step, dataset, device, steps=steps, warmup=1)
+        results[mode] = {'first step seconds': first_step, 'samples/s': throughput}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    # seconds saved per sample in the steady state versus the additional time for the first step
+    eager, compiled = results.iloc[0], results.iloc[1]
+    saved = 1 / eager['samples/s'] - 1 / compiled['samples/s']
+    overhead = compiled['first step seconds'] - eager['first step seconds']
+    results['break-even samples'] = [0, max(0, overhead / saved) if saved > 0 else np.inf]
+    return results
+
+
+def benchmark_optimizers(models: Dict[str, nn.Module], loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                         dataset: Union[TorchDataLoader, FastaiDataLoader],
+                         optimizers: Tuple[str, ...] = ('sgd', 'adamw'),
+                         implementations: Tuple[str, ...] = ('for-loop', 'foreach', 'fused'), steps: int = 20,
+                         warmup: int = 3, use_cuda_if_available: bool = True) -> pd.DataFrame:
+    """
+    Measure the time of a single optimizer step for different models, optimizers and their
+    implementations (see `create_optimizer`). The gradients are computed once for the first batch
+    of `dataset`, and only the update steps are timed. Each model is benchmarked on a copy, so the
+    given models are not modified. Implementations an optimizer does not support are skipped.
+
+    :param models: The models to compare by name, e.g., variants of `create_cnn`.
+    :param loss: The loss function to compute the gradients with.
+    :param dataset: DataLoader to take the batch from.
+    :param optimizers: The optimizers to compare.
+    :param implementations: The implementations to compare.
+    :param steps: Number of timed steps per measurement.
+    :param warmup: Number of untimed steps before each measurement.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :return: Number of parameter tensors, milliseconds per step and speedup over the first
+        implementation, i.e., the for-loop by default (columns) per model, optimizer and
+        implementation (rows).
+    """
+    device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
+    inputs, targets = next(iter(dataset))
+    inputs, targets = inputs.to(device), targets.to(device)
+    results = {}
+    for model_name, model in models.items():
+        candidate = copy.deepcopy(model).to(device)
+        candidate.train(True)
+        loss(candidate(inputs).squeeze(dim=1), targets).backward()
+        tensors = sum(p.grad is not None for p in candidate.parameters())
+        for optimizer_name in optimizers:
+            for implementation in implementations:
+                try:
+                    optimizer = create_optimizer(candidate, optimizer_name, learning_rate=1e-3, momentum=0.9,
+                                                 weight_decay=1e-4, implementation=implementation)
+                    for _ in range(warmup):
+                        optimizer.step()
+                except (RuntimeError, ValueError) as ex:
+                    warnings.warn(f'skipping {implementation} {optimizer_name}: {ex}')
+                    continue
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(steps):
+                    optimizer.step()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                results[model_name, optimizer_name, implementation] = {
+                    'parameter tensors': tensors, 'step ms': (time.perf_counter() - start) / steps * 1000}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results.index.names = ['model', 'optimizer', 'implementation']
+    results['speedup'] = (results['step ms'].groupby(level=['model', 'optimizer']).transform('first') /
+                          results['step ms'])
+    return results
+
+
+def benchmark_checkpointing(model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                            dataset: Union[TorchDataLoader, FastaiDataLoader],
+                            granularities: Tuple[str, ...] = (None, 'stage', 'sqrt', 'block'),
+                            stages: Tuple[int, ...] = (1, 2, 3, 4), steps: int = 10, warmup: int = 2,
+                            use_cuda_if_available: bool = True) -> pd.DataFrame:
+    """
+    Compare the activation memory and training throughput of a ResNet for different activation
+    checkpointing granularities (see `enable_checkpointing`). Each granularity is measured on a
+    fresh copy of the model, so the given model is not modified.
+
+    :param model: The ResNet model to benchmark.
+    :param loss: The loss function to use for training.
+    :param dataset: DataLoader to take the batches from.
+    :param granularities: The granularities to compare (None for no checkpointing).
+    :param stages: The stages (1 to 4) to checkpoint.
+    :param steps: Number of timed steps per measurement.
+    :param warmup: Number of untimed steps before each measurement.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :return: Megabytes of activations kept for the backward pass of one batch, peak CUDA memory
+        (if available) and training samples per second (columns) per granularity (rows).
+    """
+    device = torch.device('cuda:0' if (torch.cuda.is_available() and use_cuda_if_available) else 'cpu')
+    inputs, targets = next(iter(dataset))
+    inputs, targets = inputs.to(device), targets.to(device)
+    
+    def storage(tensor):
+        return tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage()
+    
+    results = {}
+    for granularity in granularities:
+        candidate = copy.deepcopy(model).to(device)
+        if granularity is not None:
+            enable_checkpointing(candidate, granularity, stages)
+        candidate.train(True)
+        optimizer = torch.optim.SGD([p for p in candidate.parameters() if p.requires_grad], lr=1e-3)
+        
+        def train_step(inputs, targets):
+            loss(candidate(inputs).squeeze(dim=1), targets).backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        
+        # count the (distinct) activation tensors kept alive for the backward pass: those saved
+        # by autograd outside of checkpointed segments, and the inputs of checkpointed segments
+        parameters = {storage(p).data_ptr() for p in candidate.parameters()}
+        saved = {}
+        
+        def pack(tensor):
+            if storage(tensor).data_ptr() not in parameters:
+                saved[storage(tensor).data_ptr()] = storage(tensor).nbytes()
+            return tensor
+        
+        def segment_input(module, args):
+            pack(args[0])
+        
+        hooks = [layer.register_forward_pre_hook(segment_input)
+                 for module in candidate.modules() if isinstance(module, CheckpointedSequential)
+                 for index, layer in enumerate(module) if index % module.segment_size == 0]
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            error = loss(candidate(inputs).squeeze(dim=1), targets)
+        error.backward()
+        optimizer.zero_grad()
+        for handle in hooks:
+            handle.remove()
+        
+        name = 'none' if granularity is None else granularity
+        results[name] = {'activation MB': sum(saved.values()) / 2 ** 20}
+        if device.type == 'cuda':
+            results[name]['peak CUDA MB'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+        results[name]['training samples/s'] = measure_throughput(train_step, dataset, device, steps=steps,
+                                                                 warmup=warmup)
+    return pd.DataFrame.from_dict(results, orient='index')
+
+
+def _data_parallel_worker(rank: int, world_size: int, port: int, num_threads: int, seed: int, results,
+                          model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                          training_data: torch.utils.data.Dataset, batch_size: int,
+                          valid_data: torch.utils.data.Dataset, kwargs: Dict) -> None:
+    # entry point of the worker processes spawned by `run_data_parallel`
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        torch.set_num_threads(num_threads)
+        set_seed(seed + rank)
+        # all processes must shuffle with the same seed to get disjoint shards
+        sampler = torch.utils.data.DistributedSampler(training_data, num_replicas=world_size, rank=rank,
+                                                      shuffle=True, seed=seed)
+        training_set = TorchDataLoader(training_data, batch_size=batch_size, sampler=sampler)
+        valid_set = TorchDataLoader(valid_data, batch_size=batch_size) if valid_data is not None else None
+        # the wrapper averages the gradients over all processes during the backward pass
+        parallel_model = nn.parallel.DistributedDataParallel(model)
+        start = time.perf_counter()
+        curves = run_gradient_descent(parallel_model, loss, training_set, valid_set=valid_set,
+                                      use_cuda_if_available=False, **kwargs)
+        seconds = time.perf_counter() - start
+        if rank == 0:
+            # serialize the parameters so they do not depend on this process staying alive
+            buffer = io.BytesIO()
+            torch.save(model.state_dict(), buffer)
+            results.put((curves, buffer.getvalue(), seconds))
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def _launch_data_parallel(num_processes: int, model: nn.Module,
+                          loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                          training_set: TorchDataLoader, valid_set: TorchDataLoader = None,
+                          num_threads: int = None, seed: int = 42, **kwargs) -> Tuple[pd.DataFrame, float]:
+    assert num_processes >= 1, 'Number of processes must be >= 1.'
+    assert isinstance(training_set, TorchDataLoader), 'Data-parallel training requires a PyTorch DataLoader.'
+    assert valid_set is None or isinstance(valid_set, TorchDataLoader), \
+        'Data-parallel training requires a PyTorch DataLoader.'
+    if num_threads is None:
+        num_threads = max(1, available_cpus() // num_processes)
+    # let the operating system choose a free port for the process group
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    results = torch.multiprocessing.get_context('spawn').SimpleQueue()
+    # the workers get a copy on the CPU, so the given model stays on its device (the trained
+    # parameters are loaded into it afterwards)
+    context = torch.multiprocessing.spawn(
+        _data_parallel_worker, nprocs=num_processes, join=False,
+        args=(num_processes, port, num_threads, seed, results, copy.deepcopy(model).cpu(), loss, training_set.dataset,
+              training_set.batch_size, valid_set.dataset if valid_set is not None else None, kwargs))
+    # read the results while waiting, as the first process blocks until they are received
+    result = None
+    while not context.join(timeout=0.1):
+        if result is None and not results.empty():
+            result = results.get()
+    if result is None:
+        result = results.get()
+    curves, state, seconds = result
+    model.load_state_dict(torch.load(io.BytesIO(state)))
+    return curves, seconds
+
+
+def run_data_parallel(num_processes: int, model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                      training_set: TorchDataLoader, valid_set: TorchDataLoader = None, num_threads: int = None,
+                      seed: int = 42, **kwargs) -> pd.DataFrame:
+    """
+    Minimize the loss of a model with data-parallel training on the CPU. Starts `num_processes`
+    local worker processes that each call `run_gradient_descent` on a different shard of the
+    training data, with the model wrapped in `DistributedDataParallel` (gloo backend) to average
+    the gradients. The effective batch size is therefore `num_processes` times the batch size of
+    `training_set`. The model, loss function and datasets must be picklable (e.g., no lambdas),
+    and the trained parameters are copied back into `model`.
+
+    :param num_processes: Number of worker processes.
+    :param model: The model to optimize the parameters of.
+    :param loss: The loss function to minimize.
+    :param training_set: DataLoader for the training data (its dataset and batch size are used).
+    :param valid_set: DataLoader for the validation data (optional, evaluated by every process).
+    :param num_threads: Number of intra-op threads per process. By default, the CPUs available to
+        this process are divided evenly among the workers.
+    :param seed: Seed for shuffling the training data (and, offset by the process index, for all
+        other random number sources of the workers).
+    :param kwargs: Further arguments for `run_gradient_descent`, e.g., `iterations`, `learning_rate`
+        and `momentum`.
+    :return: Loss per epoch, averaged over all processes as in `run_gradient_descent`.
+    """
+    curves, _ = _launch_data_parallel(num_processes, model, loss, training_set, valid_set=valid_set,
+                                      num_threads=num_threads, seed=seed, **kwargs)
+    return curves
+
+
+def benchmark_data_parallel(model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                            training_set: TorchDataLoader, process_counts: Tuple[int, ...] = (1, 2, 4, 8),
+                            iterations: int = 1, **kwargs) -> pd.DataFrame:
+    """
+    Measure how data-parallel training scales with the number of processes. Each setting trains
+    a fresh copy of the model, so the given model is not modified.
+
+    :param model: The model to train.
+    :param loss: The loss function to minimize.
+    :param training_set: DataLoader for the training data.
+    :param process_counts: The numbers of processes to compare.
+    :param iterations: Number of epochs per setting.
+    :param kwargs: Further arguments for `run_data_parallel`, e.g., `learning_rate` and `momentum`.
+    :return: Training time, throughput, speedup and parallel efficiency (columns) per number of
+        processes (rows). Process startup is not included in the training time.
+    """
+    results = {}
+    for num_processes in process_counts:
+        _, seconds = _launch_data_parallel(num_processes, copy.deepcopy(model), loss, training_set,
+                                           iterations=iterations, **kwargs)
+        results[num_processes] = {'seconds': seconds,
+                                  'samples/s': iterations * len(training_set.dataset) / seconds}
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results.index.name = 'processes'
+    results['speedup'] = results['samples/s'] / results['samples/s'].iloc[0] * results.index[0]
+    results['efficiency'] = results['speedup'] / results.index
     return results
 
 
+class FeatureCache(torch.utils.data.Dataset):
+    """
+    Dataset of precomputed backbone features and targets, memory-mapped from .npy files as written
+    by `cache_features`.
+    """
+    
+    def __init__(self, directory: Union[str, Path]):
+        directory = Path(directory)
+        self.features = np.load(directory / 'features.npy', mmap_mode='r')
+        self.targets = np.load(directory / 'targets.npy', mmap_mode='r')
+    
+    def __len__(self) -> int:
+        return len(self.targets)
+    
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        # copy the rows out of the (read-only) memory map
+        return torch.from_numpy(np.array(self.features[index])), torch.tensor(self.targets[index])
+
+
+def _ordered_loader(loader: Union[TorchDataLoader, FastaiDataLoader]) -> Union[TorchDataLoader, FastaiDataLoader]:
+    # a copy of the loader that iterates over all samples in a fixed order
+    if isinstance(loader, FastaiDataLoader):
+        return loader.new(shuffle=False, drop_last=False)
+    return TorchDataLoader(loader.dataset, batch_size=loader.batch_size, shuffle=False,
+                           num_workers=loader.num_workers, collate_fn=loader.collate_fn)
+
+
+def _is_augmented(loader: Union[TorchDataLoader, FastaiDataLoader]) -> bool:
+    # whether a fastai loader applies random transforms (e.g., from `load_image_dataset(augment=True)`)
+    if not isinstance(loader, FastaiDataLoader):
+        return False
+    split_idx = getattr(loader.dataset, 'split_idx', None)
+    
+    def is_random(transform) -> bool:
+        if not isinstance(transform, RandTransform):
+            return False
+        if transform.split_idx is not None:
+            # e.g., the transforms of `aug_transforms`, which only apply to the training split
+            return transform.split_idx == split_idx
+        # transforms applied to all splits (Resize, RandomResizedCrop) crop at random positions on
+        # the training split and in the center otherwise, and Resize does not crop when squishing
+        if isinstance(transform, Resize) and transform.method == 'squish':
+            return False
+        return split_idx == 0
+    
+    transforms = [t for pipeline in (loader.after_item, loader.after_batch) for t in getattr(pipeline, 'fs', ())]
+    return any(is_random(t) for t in transforms)
+
+
+def _hash_sample(sample, digest) -> None:
+    # feed the (nested) tensors, arrays and values of a sample into the given hash object
+    if isinstance(sample, (tuple, list)):
+        for element in sample:
+            _hash_sample(element, digest)
+    elif isinstance(sample, (torch.Tensor, np.ndarray)):
+        array = sample.detach().cpu().numpy() if isinstance(sample, torch.Tensor) else sample
+        digest.update(repr((array.dtype.str, array.shape)).encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    else:
+        digest.update(repr(sample).encode())
+
+
+def _dataset_fingerprint(loader: Union[TorchDataLoader, FastaiDataLoader], digest) -> None:
+    # feed everything that determines the inputs of the backbone into the given hash object, using
+    # only deterministic inputs (never transformed batches)
+    dataset = loader.dataset
+    items = getattr(dataset, 'items', None)
+    if items is not None:
+        # fastai datasets of files: file names, sizes, modification times and labels
+        for item in items:
+            stat = os.stat(item) if isinstance(item, (str, Path)) and os.path.exists(item) else None
+            digest.update(repr((str(item), stat and stat.st_size, stat and stat.st_mtime_ns)).encode())
+        digest.update(repr(list(getattr(dataset, 'vocab', None) or [])).encode())
+        # the labels (only the target pipelines, so no images are loaded)
+        for labels in getattr(dataset, 'tls', [])[1:]:
+            for index in range(len(labels)):
+                _hash_sample(labels[index], digest)
+        # the preprocessing (image size, normalization), as configured in the transform pipelines
+        for pipeline in (loader.after_item, loader.after_batch):
+            digest.update(repr(pipeline).encode())
+    else:
+        if isinstance(dataset, torch.utils.data.Subset):
+            digest.update(np.asarray(dataset.indices, dtype=np.int64).tobytes())
+            dataset = dataset.dataset
+        if isinstance(dataset, torch.utils.data.TensorDataset):
+            _hash_sample(dataset.tensors, digest)
+        else:
+            # generic datasets: hash every sample (still much cheaper than the backbone)
+            for index in range(len(dataset)):
+                _hash_sample(dataset[index], digest)
+
+
+def cache_features(model: nn.Module, dataset: Union[TorchDataLoader, FastaiDataLoader],
+                   cache_dir: Union[str, Path] = 'resources/feature_cache', shuffle: bool = True,
+                   use_cuda_if_available: bool = True) -> TorchDataLoader:
+    """
+    Compute the features of the frozen backbone of a pretrained model (see `create_cnn`) once for
+    all samples of a dataset, and return a DataLoader over these features to train `model.fc` on.
+    The features are stored in memory-mapped files in a subdirectory of `cache_dir` whose name is
+    derived from the backbone weights and the data, so the cache is rebuilt if either changes.
+    Loaders with random data augmentations are rejected, as these would only be applied once.
+
+    :param model: A model with a frozen backbone and a trainable classification layer `model.fc`.
+    :param dataset: DataLoader for the data to compute the features for.
+    :param cache_dir: The directory to store cached features in.
+    :param shuffle: Whether the returned DataLoader shuffles the samples in each epoch.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :return: A DataLoader of (features, target) pairs with the batch size of `dataset`.
+    """
+    assert hasattr(model, 'fc'), 'Feature caching requires a ResNet model with a classification layer "fc".'
+    assert not _is_augmented(dataset), \
+        'Feature caching requires a dataset without augmentations (use load_image_dataset(augment=False)).'
+    assert not any(p.requires_grad for name, p in model.named_parameters() if not name.startswith('fc.')), \
+        'Feature caching requires a frozen backbone (create the model with pretrained=True).'
+    head, model.fc = model.fc, nn.Identity()
+    try:
+        # cache key: backbone weights (including batch normalization statistics) and the data
+        digest = hashlib.sha1()
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        _dataset_fingerprint(dataset, digest)
+        directory = Path(cache_dir) / digest.hexdigest()
+        
+        if not (directory / 'targets.npy').exists():
+            device = torch.device('cuda:0' if use_cuda_if_available and torch.cuda.is_available() else 'cpu')
+            model.to(device)
+            model.train(False)
+            loader = _ordered_loader(dataset)
+            tmp_directory = directory.with_name(directory.name + '.tmp')
+            tmp_directory.mkdir(parents=True, exist_ok=True)
+            features = targets = None
+            position = 0
+            with torch.no_grad():
+                for inputs, batch_targets in tqdm(loader, desc='Caching features', leave=False):
+                    batch_features = model(inputs.to(device)).flatten(1).cpu().numpy()
+                    if features is None:
+                        # allocate the memory-mapped files once the feature size is known
+                        features = np.lib.format.open_memmap(
+                            tmp_directory / 'features.npy', mode='w+', dtype=np.float32,
+                            shape=(len(loader.dataset), batch_features.shape[1]))
+                        targets = np.lib.format.open_memmap(
+                            tmp_directory / 'targets.npy', mode='w+', dtype=np.int64, shape=(len(loader.dataset),))
+                    features[position:position + len(batch_features)] = batch_features
+                    targets[position:position + len(batch_features)] = batch_targets.cpu().numpy()
+                    position += len(batch_features)
+            features.flush()
+            targets.flush()
+            del features, targets
+            # only complete caches are visible under their final name
+            os.replace(tmp_directory, directory)
+    finally:
+        model.fc = head
+    
+    batch_size = dataset.batch_size if isinstance(dataset, TorchDataLoader) else dataset.bs
+    return TorchDataLoader(FeatureCache(directory), batch_size=batch_size, shuffle=shuffle)
+
+
+def fine_tune_head(model: nn.Module, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                   training_set: Union[TorchDataLoader, FastaiDataLoader], iterations: int,
+                   learning_rate: Union[float, int], momentum: Union[float, int],
+                   valid_set: Union[TorchDataLoader, FastaiDataLoader] = None,
+                   cache_dir: Union[str, Path] = 'resources/feature_cache', use_cuda_if_available: bool = True,
+                   **kwargs) -> Union[pd.DataFrame, Tuple[pd.DataFrame, ...]]:
+    """
+    Train the classification layer of a pretrained model with a frozen backbone on cached features
+    (see `cache_features`), which avoids computing the backbone in every epoch. The classification
+    layer `model.fc` is trained in place.
+
+    :param model: A model with a frozen backbone (see `create_cnn` with pretrained=True).
+    :param loss: The loss function to minimize.
+    :param training_set: DataLoader for the training data.
+    :param iterations: Amount of epochs (full iterations over the training data).
+    :param learning_rate: Learning rate for the update steps.
+    :param momentum: Momentum term for the update steps.
+    :param valid_set: DataLoader for the validation data (optional).
+    :param cache_dir: The directory to store cached features in.
+    :param use_cuda_if_available: Use CUDA-capable device with index 0 if available.
+    :param kwargs: Further arguments for `run_gradient_descent`.
+    :return: The result of `run_gradient_descent` for the classification layer.
+    """
+    training_features = cache_features(model, training_set, cache_dir, use_cuda_if_available=use_cuda_if_available)
+    valid_features = None
+    if valid_set is not None:
+        valid_features = cache_features(model, valid_set, cache_dir, shuffle=False,
+                                        use_cuda_if_available=use_cuda_if_available)
+    return run_gradient_descent(model.fc, loss, training_features, iterations, learning_rate, momentum,
+                                valid_set=valid_features, use_cuda_if_available=use_cuda_if_available, **kwargs)
+
+
+def _search_worker(create_model: Callable[..., nn.Module], model_kwargs: Dict, train_kwargs: Dict,
+                   iterations: int, seed: int, num_threads: int,
+                   loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                   training_data: torch.utils.data.Dataset, batch_size: int,
+                   valid_data: torch.utils.data.Dataset) -> Dict[str, float]:
+    # entry point of the worker processes started by `successive_halving` and `hyperband`
+    torch.set_num_threads(num_threads)
+    set_seed(seed)
+    model = create_model(**model_kwargs)
+    training_set = TorchDataLoader(training_data, batch_size=batch_size, shuffle=True)
+    valid_set = TorchDataLoader(valid_data, batch_size=batch_size)
+    start = time.perf_counter()
+    run_gradient_descent(model, loss, training_set, iterations, use_cuda_if_available=False, **train_kwargs)
+    seconds = time.perf_counter() - start
+    results = evaluate_model(model, valid_set, loss=loss, accuracy=multiclass_accuracy)
+    return {'validation loss': results['loss'], 'validation accuracy': results['accuracy'], 'seconds': seconds}
+
+
+def _trial_key_value(value):
+    # JSON fallback for trial keys, which must be the same in every run: partials by their function
+    # and arguments, functions and classes by their qualified name, other objects by their repr (if
+    # it does not contain a memory address)
+    if isinstance(value, functools.partial):
+        return {'partial': value.func, 'args': list(value.args), 'keywords': value.keywords}
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, '__qualname__'):
+        return f'{value.__module__}.{value.__qualname__}'
+    text = repr(value)
+    assert ' at 0x' not in text, f'{text} cannot be stored in the search store (use a function, a ' \
+                                 f'functools.partial or an object with a representation that identifies it).'
+    return text
+
+
+class _TrialRunner:
+    # runs training trials in a process pool and stores their results in an SQLite database, from
+    # which trials that already ran (with the same configuration, shared arguments, budget and seed)
+    # are taken
+    
+    def __init__(self, create_model: Callable[..., nn.Module],
+                 loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor], training_set: TorchDataLoader,
+                 valid_set: TorchDataLoader, model_kwargs: Dict, train_kwargs: Dict,
+                 num_processes: int, num_threads: int, seed: int, store: Union[str, Path]):
+        assert isinstance(training_set, TorchDataLoader) and isinstance(valid_set, TorchDataLoader), \
+            'Hyperparameter search requires PyTorch DataLoaders.'
+        self.model_parameters = set(inspect.signature(create_model).parameters)
+        self.train_parameters = set(inspect.signature(run_gradient_descent).parameters)
+        self.worker_args = (loss, training_set.dataset, training_set.batch_size, valid_set.dataset)
+        self.create_model = create_model
+        self.model_kwargs = model_kwargs or {}
+        self.train_kwargs = train_kwargs or {}
+        self.num_processes = num_processes or 1
+        self.num_threads = num_threads or max(1, available_cpus() // self.num_processes)
+        self.seed = seed
+        # arguments shared by all trials, which are part of the key of each stored trial, so changing
+        # them does not silently reuse results of trials that ran with different ones
+        digest = hashlib.sha1()
+        for loader in (training_set, valid_set):
+            _dataset_fingerprint(loader, digest)
+        self.shared = {'create_model': create_model, 'loss': loss,
+                       'model_kwargs': self.model_kwargs, 'train_kwargs': self.train_kwargs,
+                       'data': digest.hexdigest(), 'batch_size': training_set.batch_size}
+        Path(store).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(store))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS trials (configuration TEXT, iterations INTEGER, '
+                                'seed INTEGER, validation_loss REAL, validation_accuracy REAL, seconds REAL, '
+                                'PRIMARY KEY (configuration, iterations, seed))')
+        self.executor = None
+    
+    def __enter__(self) -> '_TrialRunner':
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.num_processes, mp_context=torch.multiprocessing.get_context('spawn'))
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.executor.shutdown(cancel_futures=True)
+        self.connection.close()
+    
+    def run(self, configurations: list, iterations: int) -> list:
+        # train each configuration for `iterations` epochs (or look up the stored result)
+        keys = [json.dumps({**self.shared, 'configuration': configuration}, sort_keys=True, default=_trial_key_value)
+                for configuration in configurations]
+        results = {}
+        futures = {}
+        for key, configuration in zip(keys, configurations):
+            if key in results or key in futures.values():
+                continue  # configurations that were sampled more than once only run once
+            row = self.connection.execute(
+                'SELECT validation_loss, validation_accuracy, seconds FROM trials '
+                'WHERE configuration = ? AND iterations = ? AND seed = ?', (key, iterations, self.seed)).fetchone()
+            if row is not None:
+                results[key] = dict(zip(('validation loss', 'validation accuracy', 'seconds'), row))
+                continue
+            unknown = set(configuration) - self.model_parameters - self.train_parameters
+            assert not unknown, f'Unknown hyperparameters: {", ".join(sorted(unknown))}.'
+            model_kwargs = {**self.model_kwargs,
+                            **{k: v for k, v in configuration.items() if k in self.model_parameters}}
+            train_kwargs = {**self.train_kwargs,
+                            **{k: v for k, v in configuration.items() if k not in self.model_parameters}}
+            futures[self.executor.submit(_search_worker, self.create_model, model_kwargs, train_kwargs,
+                                         iterations, self.seed, self.num_threads, *self.worker_args)] = key
+        # store each result as soon as it is available, so an interrupted search can be resumed
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            results[key] = future.result()
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?)',
+                                        (key, iterations, self.seed, *results[key].values()))
+        return [results[key] for key in keys]
+    
+    def halve(self, configurations: list, min_iterations: int, max_iterations: int,
+              reduction_factor: int, bracket: int = 0) -> list:
+        # successive halving: train all configurations with a small budget, keep the best
+        # 1 / reduction_factor of them and repeat with a reduction_factor times larger budget
+        trials = []
+        iterations = min_iterations
+        for rung in itertools.count():
+            results = self.run(configurations, iterations)
+            trials.extend({'bracket': bracket, 'rung': rung, 'iterations': iterations, **configuration, **result}
+                          for configuration, result in zip(configurations, results))
+            if len(configurations) <= 1 or iterations >= max_iterations:
+                break
+            # diverged trials (NaN loss) are ranked last
+            order = np.argsort([np.nan_to_num(result['validation loss'], nan=np.inf) for result in results],
+                               kind='stable')
+            num_survivors = max(1, len(configurations) // reduction_factor)
+            configurations = [configurations[index] for index in order[:num_survivors]]
+            iterations = min(iterations * reduction_factor, max_iterations)
+        return trials
+
+
+def _search_results(trials: list) -> Tuple[Dict, pd.DataFrame]:
+    # the best configuration among the trials with the largest budget of each bracket
+    frame = pd.DataFrame(trials)
+    final = frame[frame['iterations'] == frame.groupby('bracket')['iterations'].transform('max')]
+    best = trials[final['validation loss'].fillna(np.inf).idxmin()]
+    metrics = ('bracket', 'rung', 'iterations', 'validation loss', 'validation accuracy', 'seconds')
+    return {k: v for k, v in best.items() if k not in metrics}, frame
+
+
+def successive_halving(configurations: list, loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                       training_set: TorchDataLoader, valid_set: TorchDataLoader, min_iterations: int = 1,
+                       max_iterations: int = None, reduction_factor: int = 2,
+                       create_model: Callable[..., nn.Module] = create_cnn, model_kwargs: Dict = None,
+                       train_kwargs: Dict = None, num_processes: int = 2, num_threads: int = None,
+                       seed: int = 42, store: Union[str, Path] = 'resources/search.sqlite'
+                       ) -> Tuple[Dict, pd.DataFrame]:
+    """
+    Hyperparameter search by successive halving: all configurations are trained for
+    `min_iterations` epochs and evaluated on `valid_set`, then only the best
+    1 / `reduction_factor` of them (by validation loss) are trained again with a `reduction_factor`
+    times larger budget, until one configuration is left or `max_iterations` is reached. Each
+    trial trains a new model from scratch in one of `num_processes` local worker processes.
+
+    All trials are stored in an SQLite database, and trials with the same configuration, budget,
+    seed, `create_model`, loss function, `model_kwargs`, `train_kwargs` and data are taken from it
+    instead of being run again, so interrupted searches can be resumed. Functions in these arguments
+    are identified by their qualified name (use `functools.partial` rather than lambdas that
+    capture different values).
+
+    :param configurations: Hyperparameters to compare, as dicts of arguments for `create_model`
+        (e.g., "dropout" or "batchnorm") and `run_gradient_descent` (e.g., "learning_rate",
+        "momentum" or "lr_schedule"). Values must be JSON serializable.
+    :param loss: The loss function to minimize.
+    :param training_set: DataLoader for the training data (its dataset and batch size are used).
+    :param valid_set: DataLoader for the validation data.
+    :param min_iterations: Number of epochs in the first rung.
+    :param max_iterations: Maximum number of epochs (unlimited by default).
+    :param reduction_factor: Factor by which the number of configurations is reduced (and the
+        number of epochs is increased) in each rung.
+    :param create_model: Function creating a model from the model hyperparameters. It must be
+        picklable, like `create_cnn`.
+    :param model_kwargs: Arguments for `create_model` shared by all configurations (e.g., "num_classes").
+    :param train_kwargs: Arguments for `run_gradient_descent` shared by all configurations.
+    :param num_processes: Number of worker processes.
+    :param num_threads: Number of intra-op threads per process. By default, the CPUs available to
+        this process are divided evenly among the workers.
+    :param seed: Seed for the workers (the same for all trials).
+    :param store: SQLite database file for the trials.
+    :return: The best configuration, and all trials with their rung, number of epochs, validation
+        loss and accuracy and training time.
+    """
+    assert len(configurations) >= 1, 'At least one configuration is required.'
+    assert min_iterations >= 1, 'Minimum number of iterations must be >= 1.'
+    assert reduction_factor >= 2, 'Reduction factor must be >= 2.'
+    with _TrialRunner(create_model, loss, training_set, valid_set, model_kwargs, train_kwargs,
+                      num_processes, num_threads, seed, store) as runner:
+        trials = runner.halve(list(configurations), min_iterations, max_iterations or np.inf, reduction_factor)
+    return _search_results(trials)
+
+
+def hyperband(search_space: Dict[str, list], loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+              training_set: TorchDataLoader, valid_set: TorchDataLoader, max_iterations: int = 27,
+              reduction_factor: int = 3, seed: int = 42, **kwargs) -> Tuple[Dict, pd.DataFrame]:
+    """
+    Hyperparameter search with Hyperband: runs several brackets of successive halving (see
+    `successive_halving`) on configurations sampled randomly from `search_space`, from many
+    configurations with a budget of one epoch to few configurations with `max_iterations` epochs.
+    The sampled configurations only depend on `seed`, so an interrupted search can be resumed.
+
+    :param search_space: The candidate values for each hyperparameter (see `successive_halving`).
+    :param loss: The loss function to minimize.
+    :param training_set: DataLoader for the training data (its dataset and batch size are used).
+    :param valid_set: DataLoader for the validation data.
+    :param max_iterations: Maximum number of epochs per trial.
+    :param reduction_factor: Factor by which the number of configurations is reduced (and the
+        number of epochs is increased) in each rung.
+    :param seed: Seed for sampling the configurations and for the workers.
+    :param kwargs: Further arguments for `successive_halving`.
+    :return: The best configuration, and all trials with their bracket, rung, number of epochs,
+        validation loss and accuracy and training time.
+    """
+    assert reduction_factor >= 2, 'Reduction factor must be >= 2.'
+    rng = random.Random(seed)
+    num_brackets = int(math.log(max_iterations) / math.log(reduction_factor) + 1e-9) + 1
+    runner_kwargs = {name: kwargs.pop(name, default) for name, default in (
+        ('create_model', create_cnn), ('model_kwargs', None), ('train_kwargs', None), ('num_processes', 2),
+        ('num_threads', None), ('store', 'resources/search.sqlite'))}
+    assert not kwargs, f'Unknown arguments: {", ".join(sorted(kwargs))}.'
+    trials = []
+    with _TrialRunner(loss=loss, training_set=training_set, valid_set=valid_set, seed=seed, **runner_kwargs) as runner:
+        for bracket in reversed(range(num_brackets)):
+            # the most exploratory bracket starts with the most configurations and the smallest budget
+            num_configurations = math.ceil(num_brackets / (bracket + 1) * reduction_factor ** bracket)
+            min_iterations = max(1, int(max_iterations / reduction_factor ** bracket))
+            configurations = [{name: rng.choice(list(values)) for name, values in search_space.items()}
+                              for _ in range(num_configurations)]
+            trials.extend(runner.halve(configurations, min_iterations, max_iterations, reduction_factor,
+                                       bracket=bracket))
+    return _search_results(trials)
+
+
 def multiclass_accuracy(preds: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
     """
     Compute the multi-class accuracy for a given set of samples.